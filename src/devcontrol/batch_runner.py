@@ -0,0 +1,299 @@
+"""
+Runs box detection and OCR over a corpus of filings.
+
+PDFs are discovered under one or more roots (e.g. the files_by_zip or files_by_msa trees) and
+processed by lines_and_text.process_pdf on a pool of worker processes. Each finished file is
+appended to a JSONL manifest in the output directory with its status, timing and output path, so
+a rerun after a crash or interruption skips the files already done:
+
+    python batch_runner.py /home/don/Documents/Temp/WW990/files_by_msa/Austin --output /tmp/batch --workers 8
+
+Files are identified by path, size and modification time; a file that changed since it was
+processed, or that failed, is processed again.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.concurrency import bounded_map
+from utils.io_utils import atomic_write
+from utils.json_enhanced import NumpyEncoder
+from utils.logger import setup_logger
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def discover_pdfs(roots):
+    """
+    Finds the PDFs under roots, in a stable order.
+
+    Args:
+        roots (list): Directories to search recursively, or PDF files.
+
+    Returns:
+        list: Absolute paths of the PDFs, sorted within each root.
+    """
+    paths = []
+    for root in roots:
+        if os.path.isfile(root):
+            paths.append(os.path.abspath(root))
+            continue
+        found = []
+        for directory, _, files in os.walk(root):
+            found.extend(os.path.join(directory, name) for name in files if name.lower().endswith(".pdf"))
+        paths.extend(os.path.abspath(path) for path in sorted(found))
+    return list(dict.fromkeys(paths))
+
+
+def file_key(path):
+    """Identifies a version of a file by path, size and modification time."""
+    stat = os.stat(path)
+    return {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class Manifest:
+    """
+    Append-only JSONL record of processed files.
+
+    Every record is written and flushed to disk as soon as its file finishes, so the manifest
+    survives a crash up to the last finished file. A partially written last line is ignored
+    when the manifest is read back. The latest record of a path wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record["path"]] = record
+        self._file = open(path, "a")
+
+    def status(self, key):
+        """Status of the last attempt at this version of the file, or None if it was never processed."""
+        record = self.records.get(key["path"])
+        if record is None or record["size"] != key["size"] or record["mtime_ns"] != key["mtime_ns"]:
+            return None
+        return record["status"]
+
+    def append(self, record):
+        self.records[record["path"]] = record
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def output_path(output_dir, roots, pdf_path):
+    """
+    Mirrors the PDF's location below its root under output_dir/results/<root name>, e.g.
+    <output_dir>/results/files_by_zip/78701/<name>.json, so trees laid out alike (files_by_zip and
+    files_by_msa/<city>) do not overwrite each other's results. PDFs outside every directory root
+    go to results/_files, named with a hash of their path.
+    """
+    directories = [os.path.abspath(root) for root in roots if os.path.isdir(root)]
+    names = [os.path.basename(root) for root in directories]
+    for root, name in zip(directories, names):
+        if pdf_path.startswith(root + os.sep):
+            if names.count(name) > 1:
+                name = f"{name}-{_path_hash(root)}"
+            relative = os.path.join(name, os.path.relpath(pdf_path, root))
+            break
+    else:
+        stem = os.path.splitext(os.path.basename(pdf_path))[0]
+        relative = os.path.join("_files", f"{stem}-{_path_hash(pdf_path)}.pdf")
+    return os.path.join(output_dir, "results", os.path.splitext(relative)[0] + ".json")
+
+
+def _path_hash(path):
+    return hashlib.blake2b(path.encode(), digest_size=4).hexdigest()
+
+
+def process_file(pdf_path, result_path, options):
+    """
+    Processes one PDF in a worker process.
+
+    The results are written to a temporary file and renamed into place, so a result file only
+    exists once it is complete.
+
+    Returns:
+        dict: Manifest fields of the file: status, seconds, pages, boxes and error.
+    """
+    # Imported here so the parent process never loads OpenCV or Tesseract
+    from operations.lines_and_text import process_pdf
+
+    start = time.perf_counter()
+    try:
+        work_dir = os.path.splitext(result_path)[0]
+        results = process_pdf(pdf_path, work_dir, **options)
+        with atomic_write(result_path) as f:
+            json.dump(results, f, cls=NumpyEncoder)
+        return {"status": "done", "seconds": time.perf_counter() - start, "pages": len(results),
+                "boxes": sum(len(page) for page in results.values()), "error": None}
+    except Exception as e:
+        return {"status": "failed", "seconds": time.perf_counter() - start, "pages": None, "boxes": None,
+                "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
+
+
+def run_batch(roots, output_dir, workers=None, retry_failed=True, limit=None, paths=None, **options):
+    """
+    Processes every PDF under roots that the manifest does not already record as done.
+
+    Args:
+        roots (list): Directories (or PDF files) to process.
+        output_dir (str): Directory for the manifest, the log, and one results JSON per PDF
+            under results/.
+        workers (int): Number of worker processes. If None, one per CPU.
+        retry_failed (bool): Process files whose last attempt failed again. If False, they are
+            skipped like finished files.
+        limit (int): Process at most this many files in this run.
+        paths (list): PDFs to process, e.g. a selection from the filing catalog. If None, the
+            PDFs are discovered under roots. Results are placed relative to roots either way.
+        **options: Passed to lines_and_text.process_pdf (cache_dir, batch_ocr, dpi,
+            structure_dpi, template_registry, ...).
+
+    Returns:
+        dict: Counts of files done, failed and skipped in this run.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    logger = setup_logger("batch", os.path.join(output_dir, "batch.log"))
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+
+    pending_files = []
+    skipped = 0
+    for pdf_path in discover_pdfs(roots) if paths is None else paths:
+        key = file_key(pdf_path)
+        status = manifest.status(key)
+        if status == "done" or (status == "failed" and not retry_failed):
+            skipped += 1
+            continue
+        pending_files.append(key)
+    if limit is not None:
+        pending_files = pending_files[:limit]
+
+    total = len(pending_files)
+    workers = workers or os.cpu_count()
+    logger.info("%s PDFs to process, %s skipped from the manifest, %s workers", total, skipped, workers)
+    print(f"{total} PDFs to process ({skipped} skipped from the manifest), {workers} workers")
+
+    counts = {"done": 0, "failed": 0, "skipped": skipped}
+    start = time.perf_counter()
+
+    def record(key, result_path, result):
+        record = dict(key, output=result_path if result["status"] == "done" else None,
+                      finished_at=time.time(), **result)
+        manifest.append(record)
+        counts[record["status"]] += 1
+        if record["status"] == "failed":
+            logger.error("%s failed: %s", key["path"], record["error"])
+        else:
+            logger.info("%s: %s pages, %s boxes in %.1fs", key["path"], record["pages"], record["boxes"],
+                        record["seconds"])
+
+    def submit(task):
+        nonlocal executor
+        key, result_path = task
+        try:
+            return executor.submit(process_file, key["path"], result_path, options)
+        except BrokenProcessPool:
+            # A worker died; the files it had in flight fail with BrokenProcessPool as they are collected
+            logger.error("A worker process died, restarting the pool")
+            print("A worker process died, restarting the pool")
+            executor.shutdown(wait=False)
+            executor = ProcessPoolExecutor(max_workers=workers)
+            return executor.submit(process_file, key["path"], result_path, options)
+
+    suspects = []
+    tasks = ((key, output_path(output_dir, roots, key["path"])) for key in pending_files)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        # Bound the queue of submitted files so results are recorded as they finish
+        for (key, result_path), future in bounded_map(submit, tasks, 2 * workers):
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                # A worker died (e.g. in native OCR or rendering code). The file that crashed cannot
+                # be told apart, so every file in flight is failed and retried on its own at the end
+                # of the run.
+                result = _crash_result(f"a worker died while this file was in flight ({e})")
+                suspects.append((key, result_path))
+            record(key, result_path, result)
+
+            finished = counts["done"] + counts["failed"]
+            elapsed = time.perf_counter() - start
+            rate = finished / elapsed * 60
+            eta = (total - finished) / (finished / elapsed) if finished else float("inf")
+            print(f"[{finished}/{total}] {rate:.1f} docs/min, ETA {_format_duration(eta)} "
+                  f"({counts['failed']} failed)")
+
+        # Retry the files failed by a crash one at a time, so only the one that crashes stays failed
+        for key, result_path in suspects:
+            with ProcessPoolExecutor(max_workers=1) as solo:
+                try:
+                    result = solo.submit(process_file, key["path"], result_path, options).result()
+                except BrokenProcessPool as e:
+                    result = _crash_result(f"the worker died processing this file ({e})")
+            counts["failed"] -= 1
+            record(key, result_path, result)
+    finally:
+        executor.shutdown()
+        manifest.close()
+
+    logger.info("Batch finished in %.1fs: %s", time.perf_counter() - start, counts)
+    return counts
+
+
+def _crash_result(reason):
+    return {"status": "failed", "seconds": None, "pages": None, "boxes": None, "error": f"BrokenProcessPool: {reason}"}
+
+
+def _format_duration(seconds):
+    if seconds == float("inf"):
+        return "unknown"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect boxes and OCR every PDF under the given directories.")
+    parser.add_argument("roots", nargs="+", help="Directories (searched recursively) or PDF files.")
+    parser.add_argument("--output", required=True, help="Directory for the manifest, log and results.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per CPU).")
+    parser.add_argument("--no-retry-failed", action="store_true", help="Skip files whose last attempt failed.")
+    parser.add_argument("--limit", type=int, default=None, help="Process at most this many files.")
+    parser.add_argument("--cache-dir", default=None, help="OCR cache directory.")
+    parser.add_argument("--batch-ocr", action="store_true", help="OCR boxes in composite images.")
+    parser.add_argument("--dpi", type=int, default=300, help="Rendering resolution for OCR.")
+    parser.add_argument("--structure-dpi", type=int, default=None,
+                        help="Render at this resolution for box detection (two-resolution mode).")
+    parser.add_argument("--template-registry", default=None, help="Layout registry file.")
+    parser.add_argument("--catalog", default=None,
+                        help="Filing catalog; process its filings under the roots selected by --msa/--city "
+                             "instead of walking the roots.")
+    parser.add_argument("--msa", default=None, help="Select the filings of this MSA from the catalog.")
+    parser.add_argument("--city", default=None, help="Select the filings of this city from the catalog.")
+    args = parser.parse_args()
+
+    selected = None
+    if args.catalog is not None:
+        from data_management.filing_catalog import FilingCatalog
+        catalog = FilingCatalog(args.catalog)
+        prefixes = tuple(os.path.abspath(root) + os.sep for root in args.roots)
+        selected = [path for path in catalog.select(msa=args.msa, city=args.city) if path.startswith(prefixes)]
+        catalog.close()
+
+    run_batch(args.roots, args.output, workers=args.workers, retry_failed=not args.no_retry_failed,
+              limit=args.limit, paths=selected, cache_dir=args.cache_dir, batch_ocr=args.batch_ocr, dpi=args.dpi,
+              structure_dpi=args.structure_dpi, template_registry=args.template_registry)
@@ -0,0 +1,130 @@
+"""
+Randomized comparison of the fast line merging and box finding against the pairwise
+implementations they replaced.
+
+Run from src/devcontrol:
+
+    python -m benchmarks.check_equivalence --cases 3000
+
+merge_nearby_lines and find_boxes_from_lines are run on random line sets next to the original
+pairwise loops kept below, and the run exits with status 1 at the first case where their outputs
+differ. run_benchmarks runs a smaller number of cases before timing anything.
+"""
+import argparse
+import sys
+
+import numpy as np
+
+from operations import lines_and_text
+
+
+def reference_merge_nearby_lines(lines, threshold=20):
+    """The pairwise merge: each line not yet used seeds a group of the remaining similar lines."""
+    if not lines:
+        return []
+
+    merged = []
+    used = set()
+    for i, line1 in enumerate(lines):
+        if i in used:
+            continue
+        current_group = [line1]
+        used.add(i)
+        for j, line2 in enumerate(lines):
+            if j in used:
+                continue
+            if lines_and_text.are_lines_similar(line1, line2, threshold):
+                current_group.append(line2)
+                used.add(j)
+        merged.append(lines_and_text.merge_line_group(current_group))
+    return merged
+
+
+def reference_find_boxes_from_lines(horizontal_lines, vertical_lines, min_width=30, min_height=20):
+    """The H x V scan: the verticals spanning each pair of adjacent horizontal lines, pair by pair."""
+    horizontal_lines = sorted(horizontal_lines, key=lambda x: x[1])
+    vertical_lines = sorted(vertical_lines, key=lambda x: x[0])
+
+    boxes = []
+    for h1, h2 in zip(horizontal_lines, horizontal_lines[1:]):
+        h1_y, h2_y = h1[1], h2[1]
+        valid_verticals = [v_line for v_line in vertical_lines
+                           if min(v_line[1], v_line[3]) <= h1_y <= max(v_line[1], v_line[3])
+                           and min(v_line[1], v_line[3]) <= h2_y <= max(v_line[1], v_line[3])]
+        for v1, v2 in zip(valid_verticals, valid_verticals[1:]):
+            left = min(v1[0], v1[2])
+            right = max(v2[0], v2[2])
+            if right - left > min_width and h2_y - h1_y > min_height:
+                boxes.append((int(h1_y), int(left), int(h2_y), int(right)))
+    return boxes
+
+
+def random_lines(rng, count, size=3300):
+    """Line segments clustered on a few offsets, mostly axis-aligned, some near 45 degrees."""
+    offsets = rng.integers(0, size, max(count // 4, 1))
+    lines = []
+    for _ in range(count):
+        offset = int(rng.choice(offsets) + rng.integers(-25, 26))
+        start = int(rng.integers(0, size))
+        length = int(rng.integers(1, size // 2))
+        drift = int(rng.integers(-3, 4))
+        kind = rng.random()
+        if kind < 0.45:
+            lines.append([start, offset, start + length, offset + drift])
+        elif kind < 0.9:
+            lines.append([offset, start, offset + drift, start + length])
+        else:
+            lines.append([start, offset, start + length, offset + length + drift])
+    return lines
+
+
+def random_grid(rng, rows, columns, size=3300):
+    """Horizontal lines across the page and vertical lines spanning random runs of them."""
+    ys = np.sort(rng.integers(0, size, rows))
+    xs = np.sort(rng.integers(0, size, columns))
+    horizontal = [[0, int(y), size, int(y)] for y in ys]
+    vertical = []
+    for x in xs:
+        top, bottom = np.sort(rng.choice(ys, 2) if len(ys) else rng.integers(0, size, 2))
+        # Endpoints on, just short of and just past the horizontal lines
+        top, bottom = int(top + rng.integers(-2, 3)), int(bottom + rng.integers(-2, 3))
+        vertical.append([int(x), bottom, int(x), top] if rng.random() < 0.5 else [int(x), top, int(x), bottom])
+    return horizontal, vertical
+
+
+def check(cases, seed=0):
+    """Returns a description of the first case whose outputs differ, or None."""
+    rng = np.random.default_rng(seed)
+    for case in range(cases):
+        lines = random_lines(rng, int(rng.integers(1, 80)))
+        fast = lines_and_text.merge_nearby_lines([list(line) for line in lines])
+        reference = reference_merge_nearby_lines([list(line) for line in lines])
+        if len(fast) != len(reference) or not np.array_equal(np.asarray(fast, dtype=float),
+                                                             np.asarray(reference, dtype=float)):
+            return f"merge_nearby_lines differs in case {case}: {lines}"
+
+        horizontal, vertical = random_grid(rng, int(rng.integers(0, 40)), int(rng.integers(0, 15)))
+        fast = lines_and_text.find_boxes_from_lines([list(line) for line in horizontal],
+                                                    [list(line) for line in vertical], (3300, 3300))
+        reference = reference_find_boxes_from_lines(horizontal, vertical)
+        if fast != reference:
+            return f"find_boxes_from_lines differs in case {case}: {horizontal} {vertical}"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the fast line and box code with the pairwise versions.")
+    parser.add_argument("--cases", type=int, default=3000, help="Number of random cases.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    mismatch = check(args.cases, args.seed)
+    if mismatch is not None:
+        print(f"MISMATCH {mismatch}")
+        return 1
+    print(f"merge_nearby_lines and find_boxes_from_lines match the pairwise versions on {args.cases} cases.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
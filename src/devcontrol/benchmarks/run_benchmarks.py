@@ -0,0 +1,226 @@
+"""
+Per-stage benchmarks of the form processing code on synthetic pages.
+
+Run from src/devcontrol:
+
+    python -m benchmarks.run_benchmarks --pages 5
+    python -m benchmarks.run_benchmarks --pages 5 --save-baseline
+    python -m benchmarks.run_benchmarks --pages 5 --ocr
+    python -m benchmarks.run_benchmarks --pages 5 --structure-dpi 100
+
+Each run reports, per stage, the time per page, throughput (pages/s and boxes/s) and the peak
+memory allocated while the stage runs (as seen by tracemalloc, i.e. Python and NumPy allocations
+but not OpenCV's own buffers; the process' max RSS is reported as well). If a baseline file exists, every stage is compared against
+it and the run exits with status 1 when a stage is slower than the baseline by more than the
+tolerance.
+
+Before timing anything, the fast line merging and box finding are compared with the pairwise
+versions they replaced on random inputs (see check_equivalence), and the run exits with status 1
+if they differ.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+from PIL import Image
+
+from benchmarks.check_equivalence import check
+from benchmarks.synthetic_forms import generate_form
+from operations import lines_and_text
+from operations import pdf_to_text_boxes
+from utils import temp_file_rw as temp_mgr
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+class StageTimer:
+    """Accumulates wall time, peak traced memory and item counts per stage."""
+
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def run(self, stage, function, *args, boxes=0, **kwargs):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        peak = 0
+        if self.trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        totals = self.stages.setdefault(stage, {"seconds": 0.0, "pages": 0, "boxes": 0, "peak_bytes": 0})
+        totals["seconds"] += elapsed
+        totals["pages"] += 1
+        totals["boxes"] += boxes
+        totals["peak_bytes"] = max(totals["peak_bytes"], peak)
+        return result
+
+    def report(self):
+        report = {}
+        for stage, totals in self.stages.items():
+            seconds = totals["seconds"]
+            report[stage] = {
+                "seconds_per_page": seconds / totals["pages"],
+                "pages_per_second": totals["pages"] / seconds if seconds else float("inf"),
+                "boxes_per_second": totals["boxes"] / seconds if seconds and totals["boxes"] else None,
+                "peak_bytes": totals["peak_bytes"],
+            }
+        return report
+
+
+def merge_lines(horizontal, vertical):
+    return lines_and_text.merge_nearby_lines(horizontal), lines_and_text.merge_nearby_lines(vertical)
+
+
+def benchmark_page(timer, gray, ocr, batch_ocr):
+    """Times each stage of lines_and_text.detect_lines_and_boxes on one grayscale page."""
+    edges, original = timer.run("preprocess_image", lines_and_text.preprocess_image, gray)
+    horizontal, vertical = timer.run("hough_lines", lines_and_text.detect_line_segments, edges)
+    vertical = lines_and_text.ensure_form_boundaries(vertical, horizontal, original.shape)
+
+    horizontal, vertical = timer.run("merge_nearby_lines", merge_lines, horizontal, vertical)
+
+    boxes = timer.run("find_boxes_from_lines", lines_and_text.find_boxes_from_lines,
+                      horizontal, vertical, original.shape)
+    timer.stages["find_boxes_from_lines"]["boxes"] += len(boxes)
+
+    if ocr:
+        rois = []
+        for top, left, bottom, right in boxes:
+            rois.append(cv2.convertScaleAbs(original[top:bottom, left:right], alpha=1.5, beta=0))
+        timer.run("box_ocr", lines_and_text.ocr_rois, rois, batch=batch_ocr, boxes=len(rois))
+    return boxes
+
+
+def run(args):
+    timer = StageTimer(trace_memory=not args.no_memory)
+    work_dir = tempfile.mkdtemp(prefix="devcontrol_bench_")
+    ocr_pages = {}
+    detected = expected = 0
+
+    for page in range(args.pages):
+        image, cells, words = generate_form(rows=args.rows, max_columns=args.columns, noise=args.noise,
+                                            skew=args.skew, seed=args.seed + page)
+        # Pages are handed over as grayscale arrays, as process_pdf renders them
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        boxes = benchmark_page(timer, gray, args.ocr, args.batch_ocr)
+        if args.structure_dpi:
+            # Stand-in for rendering the page at the lower resolution
+            scale = args.structure_dpi / lines_and_text.REFERENCE_DPI
+            small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            timer.run("detect_structure_low_dpi", lines_and_text.detect_structure, small, scale=scale)
+        detected += len(boxes)
+        expected += len(cells)
+        ocr_pages[page] = words.to_dict()
+
+        if args.ocr:
+            page_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            timer.run("page_ocr", pdf_to_text_boxes.extract_text_from_image, [page_image],
+                      output_dir=os.path.join(work_dir, "pdf_images"))
+
+    # identify_form_elements works on the OCR output of a whole document
+    handle = temp_mgr.write_to_temp_file(ocr_pages)
+    timer.run("identify_form_elements", pdf_to_text_boxes.identify_form_elements, handle, csv_prefix=None)
+    timer.stages["identify_form_elements"]["pages"] = args.pages
+    temp_mgr.cleanup_temp_files()
+
+    return {
+        "config": {key: value for key, value in vars(args).items()
+                   if key in ("pages", "rows", "columns", "noise", "skew", "seed", "ocr", "batch_ocr",
+                              "structure_dpi")},
+        "stages": timer.report(),
+        "boxes_detected": detected,
+        "boxes_expected": expected,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Returns the stages that are slower than the baseline by more than tolerance."""
+    regressions = []
+    for stage, current in report["stages"].items():
+        reference = baseline["stages"].get(stage)
+        if reference is None:
+            continue
+        limit = reference["seconds_per_page"] * (1 + tolerance)
+        if current["seconds_per_page"] > limit:
+            regressions.append((stage, reference["seconds_per_page"], current["seconds_per_page"]))
+    return regressions
+
+
+def print_report(report):
+    print(f"{'stage':<24}{'s/page':>10}{'pages/s':>10}{'boxes/s':>12}{'peak MB':>10}")
+    for stage, result in report["stages"].items():
+        boxes_per_second = f"{result['boxes_per_second']:.0f}" if result["boxes_per_second"] else "-"
+        print(f"{stage:<24}{result['seconds_per_page']:>10.4f}{result['pages_per_second']:>10.2f}"
+              f"{boxes_per_second:>12}{result['peak_bytes'] / 1e6:>10.1f}")
+    print(f"Boxes detected: {report['boxes_detected']} of {report['boxes_expected']} drawn")
+    print(f"Max RSS: {report['max_rss_kb'] / 1024:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the form processing stages on synthetic pages.")
+    parser.add_argument("--pages", type=int, default=5, help="Number of synthetic pages.")
+    parser.add_argument("--rows", type=int, default=30, help="Grid rows per page.")
+    parser.add_argument("--columns", type=int, default=4, help="Maximum cells per row.")
+    parser.add_argument("--noise", type=float, default=0.0, help="Fraction of noisy pixels.")
+    parser.add_argument("--skew", type=float, default=0.0, help="Page rotation in degrees.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the first page.")
+    parser.add_argument("--ocr", action="store_true", help="Include the Tesseract stages.")
+    parser.add_argument("--batch-ocr", action="store_true", help="Use batched box OCR.")
+    parser.add_argument("--structure-dpi", type=int, default=None,
+                        help="Also time line and box detection on the page downscaled to this resolution.")
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace memory (lower overhead).")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline file to compare against.")
+    parser.add_argument("--save-baseline", action="store_true", help="Save this run as the baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown against the baseline, as a fraction.")
+    parser.add_argument("--output", default=None, help="Write the report to this JSON file.")
+    parser.add_argument("--check-cases", type=int, default=200,
+                        help="Random cases compared with the pairwise line and box code first (0 to skip).")
+    args = parser.parse_args()
+
+    mismatch = check(args.check_cases)
+    if mismatch is not None:
+        print(f"MISMATCH {mismatch}")
+        return 1
+
+    report = run(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("Warning: baseline was recorded with a different configuration.")
+        regressions = compare(report, baseline, args.tolerance)
+        for stage, reference, current in regressions:
+            print(f"REGRESSION {stage}: {current:.4f} s/page vs baseline {reference:.4f} s/page")
+        if regressions:
+            return 1
+        print(f"No stage slower than the baseline by more than {args.tolerance:.0%}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+import cv2
+import numpy as np
+import pandas as pd
+
+# Letter size page at 300 DPI, like the pages rendered from a filing
+PAGE_WIDTH = 2550
+PAGE_HEIGHT = 3300
+
+WORDS = ["Revenue", "Expenses", "Total", "Net", "assets", "Contributions", "gifts", "grants", "Interest",
+         "Dividends", "Rents", "Gain", "loss", "Compensation", "officers", "Taxes", "Depreciation",
+         "Other", "income", "Part", "Line", "Amount", "0", "1,250", "34,500", "987,654", "12"]
+
+OCR_COLUMNS = ["level", "page_num", "block_num", "par_num", "line_num", "word_num",
+               "left", "top", "width", "height", "conf", "text"]
+
+
+def generate_form(rows=30, max_columns=4, noise=0.0, skew=0.0, text=True, seed=0,
+                  width=PAGE_WIDTH, height=PAGE_HEIGHT, margin=150):
+    """
+    Draw a synthetic ruled form page, similar in structure to a 990-PF page.
+
+    The page is a stack of rows of varying height, each split into 1 to max_columns cells,
+    with a few words rendered in each cell.
+
+    Parameters:
+        rows: Number of rows in the grid
+        max_columns: Maximum number of cells in a row
+        noise: Fraction of pixels flipped to black or white (salt and pepper), plus a matching
+            amount of Gaussian noise
+        skew: Rotation of the page in degrees. The returned ground truth is not rotated.
+        text: Render words in the cells
+        seed: Random seed, so a given configuration always draws the same page
+        width, height: Page size in pixels
+        margin: Distance from the page edge to the grid
+
+    Returns:
+        tuple: (BGR image, list of (top, left, bottom, right) cells, DataFrame of the rendered
+            words in the schema of pytesseract.image_to_data)
+    """
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    black = (0, 0, 0)
+    thickness = 3
+
+    # Row boundaries, scaled to fill the page between the margins
+    row_heights = rng.uniform(0.6, 1.4, rows)
+    row_heights *= (height - 2 * margin) / row_heights.sum()
+    ys = np.round(margin + np.concatenate([[0], np.cumsum(row_heights)])).astype(int)
+    left_edge, right_edge = margin, width - margin
+
+    cells = []
+    for y in ys:
+        cv2.line(image, (left_edge, int(y)), (right_edge, int(y)), black, thickness)
+    cv2.line(image, (left_edge, int(ys[0])), (left_edge, int(ys[-1])), black, thickness)
+    cv2.line(image, (right_edge, int(ys[0])), (right_edge, int(ys[-1])), black, thickness)
+
+    for top, bottom in zip(ys[:-1], ys[1:]):
+        columns = int(rng.integers(1, max_columns + 1))
+        splits = np.sort(rng.choice(np.arange(left_edge + 200, right_edge - 200, 50), columns - 1, replace=False))
+        xs = [left_edge] + [int(x) for x in splits] + [right_edge]
+        for x in xs[1:-1]:
+            cv2.line(image, (x, int(top)), (x, int(bottom)), black, thickness)
+        cells.extend((int(top), int(left), int(bottom), int(right)) for left, right in zip(xs[:-1], xs[1:]))
+
+    words = []
+    if text:
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        for block_num, (top, left, bottom, right) in enumerate(cells, start=1):
+            x = left + 15
+            baseline = top + (bottom - top) // 2 + 12
+            for word_num in range(1, int(rng.integers(1, 5)) + 1):
+                word = WORDS[int(rng.integers(len(WORDS)))]
+                (word_width, word_height), _ = cv2.getTextSize(word, font, 1.0, 2)
+                if x + word_width > right - 15:
+                    break
+                cv2.putText(image, word, (x, baseline), font, 1.0, black, 2, cv2.LINE_AA)
+                words.append([5, 1, block_num, 1, 1, word_num, x, baseline - word_height, word_width,
+                              word_height, 96.0, word])
+                x += word_width + 20
+
+    if noise > 0:
+        flips = rng.random((height, width))
+        image[flips < noise / 2] = 0
+        image[flips > 1 - noise / 2] = 255
+        gaussian = rng.normal(0, 255 * noise, (height, width, 1))
+        image = np.clip(image + gaussian, 0, 255).astype(np.uint8)
+
+    if skew:
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), skew, 1.0)
+        image = cv2.warpAffine(image, rotation, (width, height), borderValue=(255, 255, 255))
+
+    return image, cells, pd.DataFrame(words, columns=OCR_COLUMNS)
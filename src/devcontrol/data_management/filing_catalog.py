@@ -0,0 +1,248 @@
+"""
+SQLite catalog of the filings on disk.
+
+Instead of moving zip code folders into per-city folders (move_zips_to_msa) and walking the tree
+for every job, the catalog records each filing once, with the fields parsed from its file name
+(010211547_202212_990PF_....pdf: EIN, tax period, form type) and the zip code of its folder, and
+selects filings by city or MSA with an indexed query:
+
+    python -m data_management.filing_catalog refresh /home/don/Documents/Temp/WW990/files_by_zip
+    python -m data_management.filing_catalog select --city Austin --form-type 990PF
+"""
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import time
+
+from data_management.austin_zipcodes import get_austin_zips
+from data_management.region_lookup import RegionLookup
+
+logger = logging.getLogger("application")
+
+DEFAULT_CATALOG = "/home/don/Documents/Temp/WW990/filings.sqlite"
+
+# <EIN>_<tax period YYYYMM>_<form type>_<rest>.pdf
+FILENAME_PATTERN = re.compile(r"^(\d{9})_(\d{6})_([0-9A-Za-z-]+)_.*\.pdf$", re.IGNORECASE)
+ZIP_PATTERN = re.compile(r"^\d{5}$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS filings (
+    path TEXT PRIMARY KEY,
+    ein TEXT,
+    tax_period TEXT,
+    form_type TEXT,
+    zip INTEGER,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS filings_zip ON filings (zip);
+CREATE INDEX IF NOT EXISTS filings_ein ON filings (ein);
+CREATE INDEX IF NOT EXISTS filings_form ON filings (form_type, tax_period);
+CREATE TABLE IF NOT EXISTS regions (
+    zip INTEGER PRIMARY KEY,
+    city TEXT NOT NULL,
+    msa TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS regions_city ON regions (city);
+CREATE INDEX IF NOT EXISTS regions_msa ON regions (msa);
+"""
+
+
+def parse_filing_path(path):
+    """
+    Parses the fields of a filing from its path.
+
+    Returns:
+        dict: ein, tax_period and form_type from the file name (None if it does not follow the
+            naming scheme) and zip from the nearest enclosing folder named by a zip code (None if
+            there is none).
+    """
+    match = FILENAME_PATTERN.match(os.path.basename(path))
+    ein, tax_period, form_type = match.groups() if match else (None, None, None)
+    zip_code = None
+    for part in reversed(os.path.dirname(path).split(os.sep)):
+        if ZIP_PATTERN.match(part):
+            zip_code = int(part)
+            break
+    return {"ein": ein, "tax_period": tax_period, "form_type": form_type and form_type.upper(), "zip": zip_code}
+
+
+class FilingCatalog:
+    """
+    Catalog of filings stored in a SQLite database.
+
+    refresh() brings the catalog up to date with a directory tree, re-parsing only the files whose
+    size or modification time changed; select() returns the paths of the filings of a region.
+    """
+
+    def __init__(self, db_path=DEFAULT_CATALOG):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(SCHEMA)
+
+    def load_regions(self, zip_to_city, msa):
+        """
+        Assigns zip codes to cities and an MSA.
+
+        Args:
+            zip_to_city (dict): Zip code -> city, e.g. the first value of get_austin_zips().
+            msa (str): Name of the MSA the zip codes belong to.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO regions (zip, city, msa) VALUES (?, ?, ?)",
+                [(int(zip_code), city, msa) for zip_code, city in zip_to_city.items()])
+
+    def load_region_lookup(self, regions):
+        """Assigns the zip codes of a RegionLookup with a known city and MSA to them."""
+        frame = regions.to_frame().dropna(subset=["city", "msa"])
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO regions (zip, city, msa) VALUES (?, ?, ?)",
+                zip(frame["zip"].tolist(), frame["city"].astype(str).tolist(), frame["msa"].astype(str).tolist()))
+
+    def refresh(self, root):
+        """
+        Updates the catalog with the PDFs under root.
+
+        New files and files whose size or mtime changed are (re)parsed, files that no longer exist
+        are removed, and unchanged files are only stat'ed. Filings under a directory that cannot be
+        read (permissions, an unmounted share) are kept as they are, not removed.
+
+        Returns:
+            dict: Counts of added, updated, removed and unchanged filings, and of the directories
+                that could not be read.
+        """
+        root = os.path.abspath(root)
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute(
+            "SELECT path, size, mtime_ns FROM filings WHERE path >= ? AND path < ?",
+            (root + os.sep, root + chr(ord(os.sep) + 1)))}
+
+        changed = []
+        unreadable = []
+        seen = 0
+        for path, stat in _scan_pdfs(root, unreadable):
+            seen += 1
+            previous = known.pop(path, None)
+            if previous == (stat.st_size, stat.st_mtime_ns):
+                continue
+            fields = parse_filing_path(path)
+            changed.append((path, fields["ein"], fields["tax_period"], fields["form_type"], fields["zip"],
+                            stat.st_size, stat.st_mtime_ns, previous is None))
+
+        if unreadable:
+            # Not found is not gone when the directory could not be listed
+            prefixes = tuple(directory + os.sep for directory in unreadable)
+            known = {path: value for path, value in known.items() if not path.startswith(prefixes)}
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO filings (path, ein, tax_period, form_type, zip, size, mtime_ns) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", [row[:-1] for row in changed])
+            # Whatever was catalogued under root but not found again is gone
+            self.connection.executemany("DELETE FROM filings WHERE path = ?", [(path,) for path in known])
+
+        added = sum(1 for row in changed if row[-1])
+        return {"added": added, "updated": len(changed) - added, "removed": len(known),
+                "unchanged": seen - len(changed), "unreadable_dirs": len(unreadable)}
+
+    def select(self, msa=None, city=None, zips=None, form_type=None, tax_period=None):
+        """
+        Returns the paths of the filings matching every given criterion, sorted.
+
+        Args:
+            msa (str): MSA name, as loaded with load_regions.
+            city (str): City name, as loaded with load_regions.
+            zips (iterable): Zip codes.
+            form_type (str): Form type, e.g. '990PF'.
+            tax_period (str): Tax period, 'YYYYMM'.
+        """
+        clauses, parameters = [], []
+        if msa is not None:
+            clauses.append("zip IN (SELECT zip FROM regions WHERE msa = ?)")
+            parameters.append(msa)
+        if city is not None:
+            clauses.append("zip IN (SELECT zip FROM regions WHERE city = ?)")
+            parameters.append(city)
+        if zips is not None:
+            zips = [int(zip_code) for zip_code in zips]
+            clauses.append(f"zip IN ({', '.join('?' * len(zips))})")
+            parameters.extend(zips)
+        if form_type is not None:
+            clauses.append("form_type = ?")
+            parameters.append(form_type.upper())
+        if tax_period is not None:
+            clauses.append("tax_period = ?")
+            parameters.append(str(tax_period))
+
+        query = "SELECT path FROM filings"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        return [path for path, in self.connection.execute(query + " ORDER BY path", parameters)]
+
+    def counts_by_city(self):
+        """Returns {city: number of filings} for the cities of the loaded regions."""
+        return dict(self.connection.execute(
+            "SELECT regions.city, COUNT(*) FROM filings JOIN regions ON filings.zip = regions.zip "
+            "GROUP BY regions.city ORDER BY regions.city"))
+
+    def close(self):
+        self.connection.close()
+
+
+def _scan_pdfs(root, unreadable):
+    """Yields (path, stat) of each PDF under root, appending the directories it cannot list to unreadable."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logger.warning("Cannot list %s, keeping its catalogued filings: %s", directory, e)
+            unreadable.append(directory)
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.lower().endswith(".pdf"):
+                yield entry.path, entry.stat()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain and query the catalog of filings.")
+    parser.add_argument("--db", default=DEFAULT_CATALOG, help="Catalog database file.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    refresh_parser = commands.add_parser("refresh", help="Catalog the PDFs under the given directories.")
+    refresh_parser.add_argument("roots", nargs="+")
+    refresh_parser.add_argument("--regions", default=None,
+                                help="CSV of zip,city,county,msa to load (default: the Austin MSA).")
+    select_parser = commands.add_parser("select", help="Print the paths of matching filings.")
+    select_parser.add_argument("--msa", default=None)
+    select_parser.add_argument("--city", default=None)
+    select_parser.add_argument("--zip", dest="zips", type=int, action="append", default=None)
+    select_parser.add_argument("--form-type", default=None)
+    select_parser.add_argument("--tax-period", default=None)
+    args = parser.parse_args()
+
+    catalog = FilingCatalog(args.db)
+    if args.command == "refresh":
+        if args.regions is not None:
+            catalog.load_region_lookup(RegionLookup.from_csv(args.regions))
+        else:
+            austin_zips, _ = get_austin_zips()
+            catalog.load_regions(austin_zips, "Austin")
+        for root in args.roots:
+            start = time.perf_counter()
+            counts = catalog.refresh(root)
+            print(f"{root}: {counts} in {time.perf_counter() - start:.2f}s")
+        print(catalog.counts_by_city())
+    else:
+        for path in catalog.select(msa=args.msa, city=args.city, zips=args.zips, form_type=args.form_type,
+                                   tax_period=args.tax_period):
+            print(path)
+    catalog.close()
@@ -2,7 +2,11 @@ import os
 import shutil
 from data_management.austin_zipcodes import get_austin_zips
 def move_zips_to_msa(zips_by_city, all_zipcodes):
-    """Move zipcode folders from all_zipcodes to output_directory by city"""
+    """
+    Move zipcode folders from all_zipcodes to output_directory by city
+
+    To select filings by city without moving anything, see data_management.filing_catalog.
+    """
     base_folder_location = "/home/don/Documents/Temp/WW990/files_by_zip/"
     target_folder_location = "/home/don/Documents/Temp/WW990/files_by_msa"
     for zipcode, city in zips_by_city.items():
@@ -0,0 +1,161 @@
+"""
+Zip code to city, county and MSA lookup.
+
+The regions are held in arrays indexed directly by the 5-digit zip code, so looking up a whole
+pandas column of zips is one fancy-indexing pass instead of a dict lookup or list scan per row:
+
+    regions = RegionLookup.from_csv("zip_regions.csv")
+    filings["msa"] = regions.lookup(filings["zip"], "msa")
+    austin = filings[regions.contains(filings["zip"], "msa", "Austin")]
+"""
+import numpy as np
+import pandas as pd
+
+from data_management.austin_zipcodes import get_austin_zips
+
+ZIP_SPACE = 100000
+FIELDS = ("city", "county", "msa")
+
+
+class RegionLookup:
+    """
+    Direct-indexed table of the city, county and MSA of each zip code.
+
+    Each field is stored as an int32 array of ZIP_SPACE category codes (-1 where unknown) plus the
+    array of category names, about 400KB per field for the whole zip space.
+    """
+
+    def __init__(self, codes, categories):
+        """
+        Args:
+            codes (dict): Field -> int32 array of ZIP_SPACE category codes.
+            categories (dict): Field -> array of the names the codes refer to.
+        """
+        self.codes = codes
+        self.categories = categories
+
+    @classmethod
+    def from_frame(cls, frame, zip_column="zip", fields=FIELDS):
+        """
+        Builds the lookup from a DataFrame with one row per zip code.
+
+        Args:
+            frame (pandas.DataFrame): Zip codes and the fields. Fields missing from the frame are
+                left unknown for every zip.
+            zip_column (str): Column holding the zip codes.
+            fields (tuple): Columns to index.
+        """
+        zips = _zip_codes(frame[zip_column])
+        known = zips >= 0
+        codes, categories = {}, {}
+        for field in fields:
+            table = np.full(ZIP_SPACE, -1, dtype=np.int32)
+            if field in frame.columns:
+                values, names = pd.factorize(frame[field], sort=True)
+                table[zips[known]] = values[known]
+            else:
+                names = np.array([], dtype=object)
+            codes[field] = table
+            categories[field] = np.asarray(names, dtype=object)
+        return cls(codes, categories)
+
+    @classmethod
+    def from_csv(cls, path, zip_column="zip", fields=FIELDS):
+        """
+        Loads the lookup from a CSV file with a header row, e.g. 'zip,city,county,msa'.
+
+        Zip codes are read as text, so leading zeros and ZIP+4 codes are handled.
+        """
+        frame = pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[""])
+        return cls.from_frame(frame, zip_column=zip_column, fields=fields)
+
+    @classmethod
+    def from_mapping(cls, zip_to_city, county=None, msa=None):
+        """
+        Builds the lookup from a zip -> city dict, such as the first value of get_austin_zips().
+
+        Args:
+            zip_to_city (dict): Zip code -> city.
+            county (str or dict): County of every zip, or zip -> county.
+            msa (str or dict): MSA of every zip, or zip -> MSA.
+        """
+        frame = pd.DataFrame({"zip": list(zip_to_city), "city": list(zip_to_city.values())})
+        for field, values in (("county", county), ("msa", msa)):
+            if isinstance(values, dict):
+                frame[field] = frame["zip"].map(values)
+            elif values is not None:
+                frame[field] = values
+        return cls.from_frame(frame)
+
+    @classmethod
+    def austin(cls):
+        """The Austin MSA, from get_austin_zips()."""
+        zip_to_city, _ = get_austin_zips()
+        return cls.from_mapping(zip_to_city, msa="Austin")
+
+    def lookup(self, zips, field="city"):
+        """
+        Looks up a field for any number of zip codes at once.
+
+        Args:
+            zips (pandas.Series or array-like): Zip codes as numbers or text ('78701',
+                '78701-1234'). Missing or malformed codes give NaN.
+            field (str): 'city', 'county' or 'msa'.
+
+        Returns:
+            pandas.Series or pandas.Categorical: The field of each zip code, as a categorical
+                Series with the index of zips if zips is a Series.
+        """
+        codes = self._codes(zips, field)
+        values = pd.Categorical.from_codes(codes, categories=self.categories[field])
+        if isinstance(zips, pd.Series):
+            return pd.Series(values, index=zips.index, name=field)
+        return values
+
+    def contains(self, zips, field, values):
+        """
+        Tests which zip codes belong to the given regions.
+
+        Args:
+            zips (pandas.Series or array-like): Zip codes, as for lookup.
+            field (str): 'city', 'county' or 'msa'.
+            values (str or iterable): Name(s) of the regions.
+
+        Returns:
+            numpy.ndarray: Boolean mask, True where the zip's field is one of values.
+        """
+        if isinstance(values, str):
+            values = [values]
+        # One flag per category, then one gather for all zips
+        selected = np.append(np.isin(self.categories[field], list(values)), False)
+        return selected[self._codes(zips, field)]
+
+    def zips(self, field, value):
+        """Returns the sorted zip codes whose field is value."""
+        matches = np.flatnonzero(self.categories[field] == value)
+        if len(matches) == 0:
+            return np.array([], dtype=np.int64)
+        return np.flatnonzero(self.codes[field] == matches[0])
+
+    def to_frame(self):
+        """Returns the known zip codes and their fields as a DataFrame, one row per zip."""
+        known = np.flatnonzero(np.any([codes >= 0 for codes in self.codes.values()], axis=0))
+        frame = pd.DataFrame({"zip": known})
+        for field in self.codes:
+            frame[field] = self.lookup(known, field)
+        return frame
+
+    def _codes(self, zips, field):
+        zips = _zip_codes(zips)
+        return np.where(zips >= 0, self.codes[field][np.maximum(zips, 0)], -1)
+
+
+def _zip_codes(zips):
+    """Converts zip codes to int64, with -1 for missing or malformed codes."""
+    series = zips if isinstance(zips, pd.Series) else pd.Series(np.asarray(zips))
+    if not pd.api.types.is_numeric_dtype(series.dtype):
+        # Text: keep the 5-digit part of ZIP+4 codes
+        series = pd.to_numeric(series.astype("string").str.strip().str[:5], errors="coerce")
+    values = series.to_numpy(dtype=float, na_value=np.nan)
+    valid = np.isfinite(values) & (values >= 0) & (values < ZIP_SPACE) & (values == np.floor(values))
+    return np.where(valid, values, -1).astype(np.int64)
@@ -9,3 +9,7 @@ class InvalidInputError(ApplicationException):
 class OperationError(ApplicationException):
     """Raised when an operation fails."""
     pass
+
+class ConfigurationError(ApplicationException):
+    """Raised when the pipeline configuration is invalid."""
+    pass
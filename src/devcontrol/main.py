@@ -1,14 +1,57 @@
+import argparse
 import json
+import logging
 import os
-from utils.io_utils import read_json, write_json, load_function
+import time
+from functools import partial
+from utils.io_utils import read_json, write_json
+from utils.pipeline_plan import compile_pipeline
+from utils.intermediate_store import IntermediateStore
+from utils.checkpoint import CheckpointStore, fingerprint_input, step_fingerprint
 from utils.logger import setup_logger
+from utils.metrics import PipelineMetrics
+from utils.json_enhanced import NumpyEncoder
+from utils import temp_file_rw as temp_mgr
+from utils.concurrency import bounded_map
 from operations import process_list, process_dict, process_directory, process_nested
+from exceptions.app_exceptions import OperationError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # Paths for working directories and logs
 working_dir = '/home/don/Documents/Temp/WW990/structure/'
 logs_dir = os.path.join(working_dir, 'logs/')
 input_dir = os.path.join(working_dir, 'input/')
 intermediates_dir = os.path.join(working_dir, 'intermediates/')
+checkpoints_dir = os.path.join(working_dir, 'checkpoints/')
+metrics_dir = os.path.join(working_dir, 'metrics/')
+
+
+def _execute_in_subprocess(manager, step, input_data, step_context):
+    """
+    Runs an operation in a worker process. Stage outputs the worker stored in memory are
+    written to disk before returning, so the parent can read their handles.
+
+    Errors are returned rather than raised, so the metrics of a failed task still reach the parent.
+
+    Returns:
+        tuple: The operation's output, the metrics recorded in the worker, for the parent to merge,
+            and the exception the operation raised (None if it succeeded).
+    """
+    manager.metrics = PipelineMetrics()
+    try:
+        return manager.execute_operation(step, input_data, step_context), manager.metrics, None
+    except Exception as e:
+        manager.logger.error("Task in context '%s' failed in worker process %s.", step_context, os.getpid(),
+                             exc_info=True)
+        return None, manager.metrics, e
+    finally:
+        temp_mgr.spill_temp_files()
+
+
+class _PendingResult:
+    """Placeholder for the result of a task submitted to a worker pool."""
+    def __init__(self, index):
+        self.index = index
 
 
 class PipelineManager:
@@ -16,169 +59,363 @@ class PipelineManager:
         self.pipeline_log = os.path.join(logs_dir, 'pipeline.log')
         self.logger = setup_logger("pipeline", self.pipeline_log)
         self.pipeline_config = self._load_config(config_file)
+        self.steps = compile_pipeline(self.pipeline_config)
         self.intermediate_folder = intermediates_dir
+        self.store = IntermediateStore(self.intermediate_folder)
+        self.checkpoints = CheckpointStore(checkpoints_dir)
+        self.metrics = PipelineMetrics(metrics_dir)
 
     def _load_config(self, config_file):
         """Loads the pipeline configuration from a file."""
         try:
             with open(config_file, 'r') as file:
                 config = json.load(file)
-                self.logger.debug(f"Loaded pipeline configuration: {json.dumps(config, indent=2)}")
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Loaded pipeline configuration: %s", json.dumps(config, indent=2))
                 return config["pipeline"]
         except Exception as e:
-            self.logger.error(f"Failed to load configuration file {config_file}: {e}")
+            self.logger.error("Failed to load configuration file %s: %s", config_file, e)
             raise
 
-    def _process_directory(self, step_config, input_path):
-        """Processes a directory, including nested subdirectories."""
-        step_name = step_config["step_name"]
-        output_data = {}
-
-        self.logger.info(f"{step_name}: Processing directory {input_path}.")
-        for root, _, files in os.walk(input_path):
-            for filename in files:
-                file_path = os.path.join(root, filename)
-                if os.path.isfile(file_path):
-                    self.logger.debug(f"Processing file {file_path}.")
-                    file_input = read_json(file_path)
-                    processed = self.execute_operation(step_config, file_input, os.path.relpath(file_path, input_path))
-                    output_data[os.path.relpath(file_path, input_path)] = processed
-
-        return output_data
-
-    def _process_nested(self, step_config, input_data):
-        """Handles processing dynamically based on the actual input data type."""
-        step_name = step_config["step_name"]
-        skip = step_config.get("skip_sequencing", False)
-        explicit_input = step_config.get("explicit_input", None)
-        self.logger.debug(f"Processing step '{step_name}' with input data structure: {type(input_data)}")
+    def _stream_directory(self, step, input_path):
+        """
+        Processes the files of a directory concurrently and streams the results to a JSONL file.
+
+        Files are read, parsed and handed to the step's operation on a bounded thread pool, as
+        set by the step's "directory" option, e.g. {"workers": 8, "output": "/path/out.jsonl"}.
+        Each result is written as one {"relpath": ..., "output": ...} line as soon as it is ready,
+        so memory use does not grow with the size of the directory.
+
+        Returns:
+            str: Path to the JSONL output file.
+        """
+        step_name = step.name
+        workers = step.directory.get("workers", 4)
+        output_path = step.directory.get("output") or os.path.join(self.intermediate_folder,
+                                                                   f"{step_name}_output.jsonl")
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        def process_file(file_path):
+            relpath = os.path.relpath(file_path, input_path)
+            return relpath, self.execute_operation(step, read_json(file_path), relpath)
+
+        def file_paths():
+            for root, _, files in os.walk(input_path):
+                for filename in files:
+                    file_path = os.path.join(root, filename)
+                    if os.path.isfile(file_path):
+                        yield file_path
+
+        self.logger.info("%s: Streaming directory %s to %s (workers=%s).",
+                         step_name, input_path, output_path, workers)
+        count = 0
+        with open(output_path, "w") as output, ThreadPoolExecutor(max_workers=workers) as executor:
+            # Bound the number of files in flight so parsed inputs do not pile up in memory
+            for _, future in bounded_map(partial(executor.submit, process_file), file_paths(), 2 * workers):
+                relpath, processed = future.result()
+                output.write(json.dumps({"relpath": relpath, "output": processed}, cls=NumpyEncoder) + "\n")
+                count += 1
+
+        self.logger.info("%s: Processed %s files from %s.", step_name, count, input_path)
+        return output_path
+
+    def _process_nested(self, step, input_data, context=None):
+        """
+        Handles processing dynamically based on the actual input data type.
+
+        Each item is run in the context of its key and index path below the step, e.g.
+        'step/pages/0', so every item's intermediate output is stored under a name of its own.
+        """
+        step_name = step.name
+        context = step_name if context is None else context
+        skip = step.skip_sequencing
+        explicit_input = step.explicit_input
+        self.logger.debug("Processing step '%s' with input data structure: %s", step_name, type(input_data))
 
         try:
             # Handle explicit input file
             if explicit_input:
-                self.logger.info(f"{step_name}: Using explicit input file {explicit_input}.")
+                self.logger.info("%s: Using explicit input file %s.", step_name, explicit_input)
                 if not os.path.exists(explicit_input):
                     raise FileNotFoundError(f"Explicit input file {explicit_input} not found.")
-                input_extension = os.path.splitext(explicit_input)[1].lower()
-                if input_extension == ".json":
-                    with open(explicit_input, "r") as file:
-                        input_data = json.load(file)  # Adjust for JSON files
+                if IntermediateStore.is_manifest(explicit_input):
+                    input_data = explicit_input  # Read below like any other stored intermediate output
                 else:
-                    input_data = explicit_input  # Pass non-JSON files as paths
-
-                # Bypass further processing if explicit input is non-JSON
-                if input_extension != ".json":
-                    self.logger.info(f"{step_name}: Skipping nested processing for non-JSON explicit input.")
-                    return self.execute_operation(step_config, input_data, step_name)
-
-            # Handle intermediate JSON files with references
-            if isinstance(input_data, str) and os.path.isfile(input_data):
-                self.logger.info(f"{step_name}: Processing intermediate file {input_data}.")
-                # with open(input_data, "r") as file:
-                #     intermediate_data = json.load(file)
-                #
-                # # Check if the JSON contains a reference to another file
-                # if intermediate_data.get("indirect_reference", False):
-                #     tmp_file_path = intermediate_data["filename"]
-                #     self.logger.info(f"{step_name}: Found referenced file {tmp_file_path}.")
-                #     if not os.path.exists(tmp_file_path):
-                #         raise FileNotFoundError(f"Referenced file {tmp_file_path} not found.")
-                #     with open(tmp_file_path, "r") as tmp_file:
-                #         input_data = json.load(tmp_file)  # Adjust for file type as needed
-                # else:
-                #     input_data = intermediate_data  # No referenced file, use intermediate data directly
-
-            if not skip:
-                # Handle dictionary (nested structure)
-                if isinstance(input_data, dict):
-                    self.logger.info(f"{step_name}: Processing dictionary structure.")
-                    return {
-                        key: self._process_nested(step_config, value)
-                        for key, value in input_data.items()
-                    }
-
-                # Handle list
-                elif isinstance(input_data, list):
-                    self.logger.info(f"{step_name}: Processing list of items.")
-                    return [
-                        self.execute_operation(step_config, item, f"{step_name}_item_{i}")
-                        for i, item in enumerate(input_data)
-                    ]
+                    input_extension = os.path.splitext(explicit_input)[1].lower()
+                    if input_extension == ".json":
+                        with open(explicit_input, "r") as file:
+                            input_data = json.load(file)  # Adjust for JSON files
+                    else:
+                        input_data = explicit_input  # Pass non-JSON files as paths
+
+                    if step.directory is not None and os.path.isdir(explicit_input):
+                        return self._stream_directory(step, explicit_input)
+
+                    # Bypass further processing if explicit input is non-JSON
+                    if input_extension != ".json":
+                        self.logger.info("%s: Skipping nested processing for non-JSON explicit input.", step_name)
+                        return self.execute_operation(step, input_data, context)
+
+            # Handle outputs of earlier steps kept in the intermediate store
+            if IntermediateStore.is_manifest(input_data):
+                self.logger.info("%s: Processing intermediate file %s.", step_name, input_data)
+                input_data = self.store.read(input_data)
+
+            # Handle directories of input files if configured for this step
+            if step.directory is not None and isinstance(input_data, str) and os.path.isdir(input_data):
+                return self._stream_directory(step, input_data)
+
+            # Fan list items and dict values out to a worker pool if configured for this step
+            if not skip and step.parallel and isinstance(input_data, (dict, list)):
+                return self._process_parallel(step, input_data, context)
+
+            # Handle dictionary (nested structure)
+            if not skip and isinstance(input_data, dict):
+                self.logger.info("%s: Processing dictionary structure.", step_name)
+                return {
+                    key: self._process_nested(step, value, f"{context}/{key}")
+                    for key, value in input_data.items()
+                }
+
+            # Handle list
+            elif not skip and isinstance(input_data, list):
+                self.logger.info("%s: Processing list of items.", step_name)
+                return [
+                    self.execute_operation(step, item, f"{context}/{i}")
+                    for i, item in enumerate(input_data)
+                ]
 
             # Handle terminal (non-iterable) values
             elif skip or isinstance(input_data, (int, float, str, bool, type(None))):
-                self.logger.info(f"{step_name}: Processing terminal value of type {type(input_data)}.")
-                return self.execute_operation(step_config, input_data, step_name)
+                self.logger.debug("%s: Processing terminal value of type %s.", step_name, type(input_data))
+                return self.execute_operation(step, input_data, context)
 
             # Handle unsupported types
             else:
-                self.logger.error(f"{step_name}: Unsupported input type {type(input_data)}.")
+                self.logger.error("%s: Unsupported input type %s.", step_name, type(input_data))
                 raise ValueError(f"Unsupported input type: {type(input_data)}")
 
         except Exception as e:
-            self.logger.error(f"Error in step '{step_name}': {e}")
+            self.logger.error("Error in step '%s': %s", step_name, e)
             raise
 
-    def execute_operation(self, step_config, input_data, step_context):
-        """Executes a single operation as defined in the pipeline configuration."""
-        skip_step = step_config.get("skip_step", False)
-        step_name = step_config["step_name"]
-        module = step_config["module"]
-        function_name = step_config["function"]
+    def _process_parallel(self, step, input_data, context):
+        """
+        Runs the step on every list item and dict value of input_data concurrently.
+
+        The nested structure is first flattened into independent tasks, which are run on a
+        thread or process pool as set by the step's "parallel" option, e.g.
+        {"mode": "process", "workers": 8}. Results are put back in place, so the output has
+        the same structure and order as the serial path, and each task runs in the same
+        key and index path context as it would there.
+        """
+        step_name = step.name
+        mode = step.parallel.get("mode", "thread")
+        workers = step.parallel.get("workers")
+        executor_class = ProcessPoolExecutor if mode == "process" else ThreadPoolExecutor
+
+        tasks = []
+
+        def plan(data, path):
+            # Replace each unit of work with a placeholder holding its task index
+            if isinstance(data, dict):
+                return {key: plan(value, f"{path}/{key}") for key, value in data.items()}
+            elif isinstance(data, list):
+                planned = []
+                for i, item in enumerate(data):
+                    tasks.append((item, f"{path}/{i}"))
+                    planned.append(_PendingResult(len(tasks) - 1))
+                return planned
+            elif isinstance(data, (int, float, str, bool, type(None))):
+                tasks.append((data, path))
+                return _PendingResult(len(tasks) - 1)
+            else:
+                raise ValueError(f"Unsupported input type: {type(data)}")
+
+        planned = plan(input_data, context)
+        self.logger.info("%s: Processing %s items with %s pool (workers=%s).", step_name, len(tasks), mode, workers)
+
+        if mode == "process":
+            # Create the handle directory before forking so workers share it with this process
+            temp_mgr.ensure_spill_dir()
+            run_task = partial(_execute_in_subprocess, self)
+        else:
+            run_task = self.execute_operation
 
-        self.logger.info(f"Executing step '{step_name}' using {module}.{function_name} in context '{step_context}'.")
+        def task_error(future):
+            if future.exception() is not None:
+                return future.exception()
+            return future.result()[2] if mode == "process" else None
 
+        executor = executor_class(max_workers=workers)
         try:
-            if skip_step:
-                return input_data  # output data = input data with no intermediate store
+            futures = [executor.submit(run_task, step, item, context) for item, context in tasks]
+            # Stop at the first failure; the tasks already running finish during shutdown
+            pending = futures
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                if any(task_error(future) is not None for future in done):
+                    break
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
 
-            # Dynamically load the function
-            operation = load_function(module, function_name)
+        if mode == "process":
+            # Every worker that returned counts, the failed ones included
+            for future in futures:
+                if not future.cancelled() and future.exception() is None:
+                    self.metrics.merge(future.result()[1])
 
-            # Log structure of input data
-            self.logger.debug(f"Input data for step '{step_name}': {type(input_data)}")
+        failed = [i for i, future in enumerate(futures) if not future.cancelled() and task_error(future) is not None]
+        if failed:
+            index = failed[0]
+            context = tasks[index][1]
+            error = task_error(futures[index])
+            raise OperationError(f"Step '{step_name}' failed in context '{context}': {error}") from error
 
-            output_data = operation(input_data)
+        results = [future.result() for future in futures]
+        if mode == "process":
+            results = [output for output, _, _ in results]
 
-            # Write intermediate data if enabled for this step
-            if step_config.get("use_intermediate_file", False):
-                output_file = os.path.join(self.intermediate_folder, f"{step_name}_{step_context}_output.json")
-                tmp_file_path = os.path.join("/tmp", f"{step_name}_output.json")
+        def rebuild(data):
+            if isinstance(data, dict):
+                return {key: rebuild(value) for key, value in data.items()}
+            elif isinstance(data, list):
+                return [rebuild(item) for item in data]
+            return results[data.index]
+
+        return rebuild(planned)
+
+    def execute_operation(self, step, input_data, step_context):
+        """Executes a single operation as defined by a compiled pipeline step."""
+        step_name = step.name
+
+        self.logger.info("Executing step '%s' using %s.%s in context '%s'.",
+                         step_name, step.module, step.function, step_context)
+
+        try:
+            if step.skip_step:
+                return input_data  # output data = input data with no intermediate store
 
-                # Simulate writing to the /tmp directory
-                with open(tmp_file_path, "w") as tmp_file:
-                    json.dump(output_data, tmp_file)
+            # Log structure of input data
+            self.logger.debug("Input data for step '%s': %s", step_name, type(input_data))
 
-                # Write metadata JSON pointing to the /tmp file
-                metadata = {"filename": tmp_file_path, "indirect_reference": True}
-                with open(output_file, "w") as file:
-                    json.dump(metadata, file)
+            start = time.perf_counter()
+            try:
+                output_data = step.operation(input_data, **step.options)
+            except Exception:
+                self.metrics.record_item(step_name, time.perf_counter() - start, failed=True)
+                raise
+            self.metrics.record_item(step_name, time.perf_counter() - start)
 
-                self.logger.info(f"Intermediate data written to {output_file} referencing {tmp_file_path}.")
+            # Write intermediate data if enabled for this step
+            if step.use_intermediate_file:
+                manifest_path = self.store.write(step_name, step_context, output_data)
+                self.logger.info("Intermediate data for '%s' written to %s.", step_context, manifest_path)
 
             return output_data
         except Exception as e:
-            self.logger.error(f"Error during execution of step '{step_name}': {e}")
+            self.logger.error("Error during execution of step '%s': %s", step_name, e)
             raise
 
-    def run_pipeline(self, input_path, output_file):
-        """Runs the pipeline as defined in the configuration."""
+    def run_pipeline(self, input_path, output_file, from_step=None, force=False, profile_step=None,
+                     profiler="cprofile", measure_sizes=False):
+        """
+        Runs the pipeline as defined in the configuration.
+
+        Each step's output is fingerprinted from its input, its configuration and its operation's
+        module version. The run resumes after the last step with a matching checkpoint, so changing
+        a downstream step only recomputes that step and the ones after it.
+
+        Args:
+            input_path (str): Raw input passed to the first step.
+            output_file (str): Path of the final JSON output.
+            from_step (str): Name of a step to recompute from, ignoring checkpoints of it and later steps.
+            force (bool): Ignore all checkpoints and recompute every step.
+            profile_step (str): Name of a step to profile, in addition to steps with a "profile" option.
+            profiler (str): Profiler used for profile_step, "cprofile" or "tracemalloc".
+            measure_sizes (bool): Record the estimated size of each step's input and output, which
+                walks the data of every step.
+
+        Per-step metrics are written to metrics_dir as run_report.json and pipeline.prom, along with
+        the output of any profiler.
+        """
+        self.metrics = PipelineMetrics(metrics_dir, measure_sizes=measure_sizes)
         try:
             input_data = input_path  # Pass raw input path to the first step
-            self.logger.debug(f"Pipeline starting with raw input: {input_data}")
+            self.logger.debug("Pipeline starting with raw input: %s", input_data)
+
+            step_names = [step.name for step in self.steps]
+            for name in (from_step, profile_step):
+                if name is not None and name not in step_names:
+                    raise ValueError(f"Unknown step '{name}'. Steps are: {', '.join(step_names)}")
+            recompute_from = 0 if force else step_names.index(from_step) if from_step else len(self.steps)
 
-            for step_config in self.pipeline_config:
-                self.logger.debug(f"Starting pipeline step: {json.dumps(step_config, indent=2)}")
-                input_data = self._process_nested(step_config, input_data)
+            # The fingerprint chain depends only on configuration, so it is computed up front
+            fingerprints = []
+            fingerprint = fingerprint_input(input_path)
+            for step in self.steps:
+                fingerprint = step_fingerprint(fingerprint, step)
+                fingerprints.append(fingerprint)
+
+            # Resume after the last step that has a usable checkpoint
+            start = 0
+            for i in range(min(recompute_from, len(self.steps)) - 1, -1, -1):
+                step = self.steps[i]
+                if step.checkpoint and not step.skip_step and self.checkpoints.exists(step.name, fingerprints[i]):
+                    self.logger.info("Loading checkpoint of step '%s' (%s).", step.name, fingerprints[i])
+                    input_data = self.checkpoints.load(step.name, fingerprints[i])
+                    self.metrics.get(step.name).loaded_from_checkpoint = True
+                    start = i + 1
+                    break
+
+            for i, step in enumerate(self.steps[start:], start=start):
+                self.logger.debug("Starting pipeline step: %r", step)
+                profile = step.profile + ((profiler,) if step.name == profile_step else ())
+                with self.metrics.step(step.name, input_data, profile=profile):
+                    input_data = self._process_nested(step, input_data)
+                self.metrics.record_output(step.name, input_data)
+                if step.checkpoint and not step.skip_step:
+                    self.checkpoints.save(step.name, fingerprints[i], input_data)
 
             write_json(input_data, output_file)
-            self.logger.info(f"Pipeline execution completed. Final output written to {output_file}.")
+            self.logger.info("Pipeline execution completed. Final output written to %s.", output_file)
+
+            # Stage outputs referenced by the final output outlive the run
+            temp_mgr.cleanup_temp_files(keep=temp_mgr.find_temp_handles(input_data))
         except Exception as e:
-            self.logger.error(f"Pipeline execution failed: {e}")
+            self.logger.error("Pipeline execution failed: %s", e)
+            temp_mgr.cleanup_temp_files()
             raise
+        finally:
+            self._write_metrics()
+
+    def _write_metrics(self):
+        """Exports the metrics of the run as a JSON report and a Prometheus textfile."""
+        try:
+            self.metrics.write_report(os.path.join(metrics_dir, 'run_report.json'))
+            self.metrics.write_prometheus(os.path.join(metrics_dir, 'pipeline.prom'))
+            self.logger.info("Run metrics written to %s.", metrics_dir)
+        except OSError as e:
+            self.logger.error("Failed to write run metrics: %s", e)
 
 if __name__ == "__main__":
-    pipeline = PipelineManager(config_file=os.path.join('.', "config/pipeline_config.json"))
-    infile = os.path.join(input_dir, "/tmp/tmp45cvctw7.json")
-    outfile = os.path.join(intermediates_dir, "final_output.json")
-    pipeline.run_pipeline(infile, outfile)
+    parser = argparse.ArgumentParser(description="Run the form processing pipeline.")
+    parser.add_argument("--config", default=os.path.join('.', "config/pipeline_config.json"),
+                        help="Pipeline configuration file.")
+    parser.add_argument("--input", default=os.path.join(input_dir, "/tmp/tmp45cvctw7.json"),
+                        help="Raw input passed to the first step.")
+    parser.add_argument("--output", default=os.path.join(intermediates_dir, "final_output.json"),
+                        help="Final output file.")
+    parser.add_argument("--from-step", default=None,
+                        help="Recompute this step and every later step, ignoring their checkpoints.")
+    parser.add_argument("--force", action="store_true", help="Ignore all checkpoints.")
+    parser.add_argument("--profile-step", default=None, help="Profile this step.")
+    parser.add_argument("--profiler", choices=("cprofile", "tracemalloc"), default="cprofile",
+                        help="Profiler used for --profile-step.")
+    parser.add_argument("--measure-sizes", action="store_true",
+                        help="Record the estimated size of each step's input and output in the metrics.")
+    args = parser.parse_args()
+
+    pipeline = PipelineManager(config_file=args.config)
+    pipeline.run_pipeline(args.input, args.output, from_step=args.from_step, force=args.force,
+                          profile_step=args.profile_step, profiler=args.profiler, measure_sizes=args.measure_sizes)
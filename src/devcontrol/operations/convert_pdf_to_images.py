@@ -1,12 +1,55 @@
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 
 
-def convert_pdf_to_images(input_path):
-    """Convert a PDF file into a list of images."""
+def convert_pdf_to_images(input_path, stream=False, window=1, dpi=300, grayscale=False):
+    """
+    Convert a PDF file into a list of images.
+
+    Args:
+        input_path (str): Path to the PDF file.
+        stream (bool): If True, return a generator that renders `window` pages at a time instead of a list
+            holding every page, so memory use does not grow with the number of pages.
+        window (int): Number of pages rendered per pdftoppm call when streaming.
+        dpi (int): Rendering resolution.
+        grayscale (bool): Render 8-bit grayscale ("L") images, a third of the size of RGB pages.
+
+    Returns:
+        list or generator: PIL images, one per page, in page order.
+    """
     try:
-        images = convert_from_path(input_path, dpi=300)
+        if stream:
+            page_count = pdfinfo_from_path(input_path)["Pages"]
+            return iter_pdf_pages(input_path, page_count, window=window, dpi=dpi, grayscale=grayscale)
+        images = convert_from_path(input_path, dpi=dpi, grayscale=grayscale)
         # Optionally save images or return directly
         result =  [image for image in images]
         return result
     except Exception as e:
         raise ValueError(f"Error converting PDF to images: {e}")
+
+
+def iter_pdf_pages(input_path, page_count, window=1, dpi=300, grayscale=False):
+    """
+    Yield the pages of a PDF one at a time, rendering at most `window` pages at once.
+
+    Args:
+        input_path (str): Path to the PDF file.
+        page_count (int): Number of pages in the PDF.
+        window (int): Number of pages rendered per pdftoppm call.
+        dpi (int): Rendering resolution.
+        grayscale (bool): Render 8-bit grayscale ("L") images.
+
+    Yields:
+        PIL.Image.Image: The next page image.
+    """
+    window = max(1, window)
+    for first_page in range(1, page_count + 1, window):
+        last_page = min(first_page + window - 1, page_count)
+        try:
+            pages = convert_from_path(input_path, dpi=dpi, first_page=first_page, last_page=last_page,
+                                      grayscale=grayscale)
+        except Exception as e:
+            raise ValueError(f"Error converting PDF pages {first_page}-{last_page} to images: {e}")
+        while pages:
+            # Hand pages over one by one so each can be released once consumed
+            yield pages.pop(0)
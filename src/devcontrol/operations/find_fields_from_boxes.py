@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 
@@ -17,5 +18,169 @@ def process_groups(input_file, output_file):
     grouped.to_csv(output_file, index=False)
 
 
+class BoxGrid:
+    """
+    Uniform grid index over the boxes of one page.
+
+    Every box is registered in each grid cell it overlaps, as a cell id sorted array, so the
+    candidate boxes of any number of points are found with two searchsorted calls instead of a
+    test against every box.
+    """
+
+    def __init__(self, boxes, cell_size=None):
+        """
+        Args:
+            boxes (array-like): (top, left, bottom, right) of each box, in pixels.
+            cell_size (int): Side of the grid cells. If None, the median box size is used, so a
+                typical box covers a few cells.
+        """
+        self.boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        top, left, bottom, right = self.boxes.T
+        if cell_size is None:
+            heights = np.maximum(bottom - top, 1)
+            widths = np.maximum(right - left, 1)
+            cell_size = int(np.sqrt(np.median(heights) * np.median(widths))) if len(self.boxes) else 1
+        self.cell_size = max(int(cell_size), 1)
+        self.area = (bottom - top) * (right - left)
+
+        rows0, cols0 = np.maximum(top, 0) // self.cell_size, np.maximum(left, 0) // self.cell_size
+        rows1, cols1 = np.maximum(bottom, 0) // self.cell_size, np.maximum(right, 0) // self.cell_size
+        self.columns = int(cols1.max()) + 1 if len(self.boxes) else 1
+        self.rows = int(rows1.max()) + 1 if len(self.boxes) else 1
+
+        # One (cell, box) entry per cell each box overlaps
+        spans = cols1 - cols0 + 1
+        counts = (rows1 - rows0 + 1) * spans
+        box_index = np.repeat(np.arange(len(self.boxes)), counts)
+        offset = _ranks(counts)
+        cell_rows = rows0[box_index] + offset // spans[box_index]
+        cell_cols = cols0[box_index] + offset % spans[box_index]
+        cell_ids = cell_rows * self.columns + cell_cols
+
+        order = np.argsort(cell_ids, kind='stable')
+        self._cell_ids = cell_ids[order]
+        self._box_index = box_index[order]
+
+    def locate(self, x, y):
+        """
+        Finds the box containing each point.
+
+        Args:
+            x, y (array-like): Point coordinates, in pixels.
+
+        Returns:
+            numpy.ndarray: Index of the smallest box containing each point (the innermost of nested
+                boxes), or -1 for points outside every box.
+        """
+        x = np.asarray(x, dtype=np.int64)
+        y = np.asarray(y, dtype=np.int64)
+        result = np.full(len(x), -1, dtype=np.int64)
+        if len(self.boxes) == 0 or len(x) == 0:
+            return result
+
+        col = x // self.cell_size
+        row = y // self.cell_size
+        on_grid = (x >= 0) & (y >= 0) & (col < self.columns) & (row < self.rows)
+        cell = np.where(on_grid, row * self.columns + col, -1)
+        start = np.searchsorted(self._cell_ids, cell, side='left')
+        stop = np.searchsorted(self._cell_ids, cell, side='right')
+        counts = np.where(on_grid, stop - start, 0)
+
+        # Test each point against every box registered in its cell
+        point = np.repeat(np.arange(len(x)), counts)
+        box = self._box_index[np.repeat(start, counts) + _ranks(counts)]
+        top, left, bottom, right = self.boxes[box].T
+        inside = (top <= y[point]) & (y[point] <= bottom) & (left <= x[point]) & (x[point] <= right)
+        point, box = point[inside], box[inside]
+
+        # Keep the smallest containing box of each point
+        order = np.lexsort((self.area[box], point))
+        point, box = point[order], box[order]
+        first = np.ones(len(point), dtype=bool)
+        first[1:] = point[1:] != point[:-1]
+        result[point[first]] = box[first]
+        return result
+
+
+def _ranks(counts):
+    """0, 1, ..., count - 1 for each count, concatenated."""
+    counts = np.asarray(counts, dtype=np.int64)
+    total = int(counts.sum())
+    return np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def assign_words_to_boxes(words, boxes, page_columns, output_file=None, cell_size=None):
+    """
+    Labels each OCR word with the detected box it falls in, as the input of process_groups.
+
+    A word belongs to the smallest box containing its center. The words of each page are located
+    all at once in a BoxGrid of that page's boxes, so the cost grows with the number of words
+    rather than words times boxes, and a whole corpus of word tables can be joined in one call.
+
+    Args:
+        words (pandas.DataFrame or str): Words in Tesseract's image_to_data layout (left, top,
+            width, height, text, ...), or a CSV file of them. Rows of other levels than 5
+            (words) are dropped.
+        boxes (pandas.DataFrame or str): (top, left, bottom, right) of each box, as returned by
+            lines_and_text.find_boxes_from_lines, plus the page columns, or a CSV file of them.
+            An optional 'box' column names the boxes; otherwise they are numbered in order
+            within each page.
+        page_columns (tuple): Columns identifying a page in both tables, e.g.
+            ('document', 'page') for a corpus. Tesseract's own page_num is 1 for every image
+            OCR'd on its own, so it does not tell pages apart; key the tables by a column
+            holding the document and page index instead.
+        output_file (str): CSV file to write the labeled words to. If None, nothing is written.
+        cell_size (int): Grid cell size, see BoxGrid.
+
+    Returns:
+        pandas.DataFrame: The words with bottom, right and group columns added. group is
+            '<page columns>_<box>' for words inside a box, NaN otherwise.
+    """
+    if isinstance(words, str):
+        words = pd.read_csv(words)
+    if isinstance(boxes, str):
+        boxes = pd.read_csv(boxes)
+    page_columns = list(page_columns)
+    for name, table in (("words", words), ("boxes", boxes)):
+        missing = [column for column in page_columns if column not in table.columns]
+        if missing:
+            raise ValueError(f"The {name} table has no page column(s) {missing}")
+
+    if 'level' in words.columns:
+        words = words[words['level'] == 5]
+    # Positional from here on: concatenated per-page tables repeat index labels
+    words = words.assign(bottom=words['top'] + words['height'],
+                         right=words['left'] + words['width']).reset_index(drop=True)
+    if 'box' not in boxes.columns:
+        boxes = boxes.assign(box=boxes.groupby(page_columns, sort=False).cumcount())
+
+    page_boxes = {_page_key(key): page for key, page in boxes.groupby(page_columns, sort=False)}
+    labels = np.full(len(words), np.nan, dtype=object)
+    for key, positions in words.groupby(page_columns, sort=False).indices.items():
+        key = _page_key(key)
+        page_box = page_boxes.get(key)
+        if page_box is None:
+            continue
+        page = words.iloc[positions]
+        grid = BoxGrid(page_box[['top', 'left', 'bottom', 'right']].to_numpy(), cell_size=cell_size)
+        located = grid.locate((page['left'] + page['width'] // 2).to_numpy(),
+                              (page['top'] + page['height'] // 2).to_numpy())
+        found = located >= 0
+        names = page_box['box'].astype(str).to_numpy()[located[found]]
+        prefix = "_".join(str(value) for value in key)
+        labels[positions[found]] = [f"{prefix}_{name}" for name in names]
+
+    words = words.assign(group=labels)
+    if output_file is not None:
+        words.to_csv(output_file, index=False)
+    return words
+
+
+def _page_key(key):
+    """Group keys as tuples, whether pandas gives a scalar or a tuple for a single column."""
+    return key if isinstance(key, tuple) else (key,)
+
+
 # Usage
-process_groups('input.csv', 'output.csv')
\ No newline at end of file
+if __name__ == "__main__":
+    process_groups('input.csv', 'output.csv')
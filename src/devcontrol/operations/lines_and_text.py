@@ -1,11 +1,33 @@
 import csv
+import logging
 import os
-import pytesseract
+import subprocess
 import numpy as np
 import cv2
 
 from PIL import Image
 import pdf2image
+from pdf2image import pdfinfo_from_path
+
+from operations.convert_pdf_to_images import iter_pdf_pages
+from utils.layout_templates import get_layout_registry
+from utils.ocr_cache import get_ocr_cache
+from utils.ocr_engine import get_engine_pool
+
+logger = logging.getLogger("application")
+
+# Tesseract settings for OCR of a single form box
+BOX_OCR_CONFIG = r'--oem 3 --psm 6'
+
+# Layout of the composite images used for batched box OCR
+BATCH_MAX_HEIGHT = 8000
+BATCH_GAP = 40
+
+# Resolution the pixel sizes of the line and box detection are tuned for
+REFERENCE_DPI = 300
+
+# Margin around the boxes of a page when re-rendering them for OCR, in pixels
+RENDER_PADDING = 8
 
 
 def extract_pdf_pages(pdf_path, output_dir):
@@ -26,16 +48,93 @@ def extract_pdf_pages(pdf_path, output_dir):
     return tiff_files
 
 
-def preprocess_image(image_path):
-    img = cv2.imread(image_path)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+def load_grayscale(image):
+    """
+    Return a page as a 2-D uint8 grayscale array.
+
+    Parameters:
+        image: Path of an image file, PIL image, or numpy array (grayscale, or BGR as read by OpenCV)
+
+    Returns:
+        numpy.ndarray: The grayscale page. Arrays already in grayscale and PIL images in "L" mode
+            are used as they are, without converting or copying the pixels again.
+    """
+    if isinstance(image, str):
+        gray = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise FileNotFoundError(f"Cannot read image {image}")
+        return gray
+    if isinstance(image, Image.Image):
+        if image.mode != "L":
+            image = image.convert("L")
+        return np.asarray(image)
+    if image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def detection_parameters(scale=1.0):
+    """
+    Pixel sizes used by the line and box detection for a page rendered at scale * REFERENCE_DPI.
+
+    Returns:
+        dict: kernel_length (preprocess_image), hough_threshold, min_line_length and max_line_gap
+            (detect_line_segments), boundary_tolerance (ensure_form_boundaries), merge_threshold
+            (merge_nearby_lines), min_box_width, min_box_height and span_tolerance
+            (find_boxes_from_lines)
+    """
+    return {
+        'kernel_length': max(3, round(25 * scale)),
+        'hough_threshold': max(10, round(50 * scale)),
+        'min_line_length': 100 * scale,
+        'max_line_gap': max(1, round(10 * scale)),
+        'boundary_tolerance': 20 * scale,
+        'merge_threshold': 20 * scale,
+        'min_box_width': 30 * scale,
+        'min_box_height': 20 * scale,
+        # Line ends are only known to a pixel, which matters once a pixel is more than a pixel at REFERENCE_DPI
+        'span_tolerance': 1 if scale < 1 else 0,
+    }
+
+
+def preprocess_image(image, kernel_length=25):
+    """
+    Extract the ruled lines of a page.
+
+    Parameters:
+        image: Page as accepted by load_grayscale
+        kernel_length: Minimum length of a line segment kept by the morphological opening
+
+    Returns:
+        tuple: (binary image of the horizontal and vertical lines, grayscale page)
+    """
+    (horizontal, vertical), gray = line_masks(image, kernel_length=kernel_length)
+
+    # Combine horizontal and vertical lines
+    lines = cv2.bitwise_or(horizontal, vertical)
+
+    return lines, gray
+
+
+def line_masks(image, kernel_length=25):
+    """
+    Extract the horizontal and vertical lines of a page as separate binary images.
+
+    Parameters:
+        image: Page as accepted by load_grayscale
+        kernel_length: Minimum length of a line segment kept by the morphological opening
+
+    Returns:
+        tuple: ((horizontal lines, vertical lines), grayscale page)
+    """
+    gray = load_grayscale(image)
 
     # Binary threshold to separate lines from text
     _, binary = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)
 
     # Separate horizontal and vertical elements
-    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (25, 1))
-    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 25))
+    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_length, 1))
+    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, kernel_length))
 
     # Detect horizontal lines
     horizontal = cv2.morphologyEx(binary, cv2.MORPH_OPEN, horizontal_kernel)
@@ -43,23 +142,375 @@ def preprocess_image(image_path):
     # Detect vertical lines
     vertical = cv2.morphologyEx(binary, cv2.MORPH_OPEN, vertical_kernel)
 
-    # Combine horizontal and vertical lines
-    lines = cv2.bitwise_or(horizontal, vertical)
+    return (horizontal, vertical), gray
+
+
+def detect_structure(image, scale=1.0):
+    """
+    Detect the ruled lines and boxes of a form page.
+
+    Parameters:
+        image: Page as accepted by load_grayscale
+        scale: Resolution of the page relative to REFERENCE_DPI, e.g. 1/3 for a 100 DPI page.
+            The pixel sizes of the detection are scaled to match (see detection_parameters).
+
+    Returns:
+        tuple: (grayscale page, horizontal lines, vertical lines, list of (top, left, bottom, right) boxes)
+    """
+    params = detection_parameters(scale)
+    hough = {'threshold': params['hough_threshold'], 'min_line_length': params['min_line_length'],
+             'max_line_gap': params['max_line_gap']}
+
+    if scale < 1:
+        # Below the reference resolution the short dividers between cells get too few votes when
+        # they share the Hough transform with the long rules, so each orientation is run on its own
+        (horizontal_mask, vertical_mask), original = line_masks(image, kernel_length=params['kernel_length'])
+        horizontal_lines = detect_line_segments(horizontal_mask, **hough)[0]
+        vertical_lines = detect_line_segments(vertical_mask, **hough)[1]
+    else:
+        edges, original = preprocess_image(image, kernel_length=params['kernel_length'])
+        horizontal_lines, vertical_lines = detect_line_segments(edges, **hough)
+
+    # Add form boundaries if missing
+    vertical_lines = ensure_form_boundaries(vertical_lines, horizontal_lines, original.shape,
+                                            tolerance=params['boundary_tolerance'])
+
+    # Merge nearby lines
+    horizontal_lines = merge_nearby_lines(horizontal_lines, threshold=params['merge_threshold'])
+    vertical_lines = merge_nearby_lines(vertical_lines, threshold=params['merge_threshold'])
+
+    # Find boxes using our intersection detection
+    boxes = find_boxes_from_lines(horizontal_lines, vertical_lines, original.shape,
+                                  min_width=params['min_box_width'], min_height=params['min_box_height'],
+                                  span_tolerance=params['span_tolerance'])
+    return original, horizontal_lines, vertical_lines, boxes
+
+
+def find_structure(image, scale=1.0, registry=None):
+    """
+    Find the boxes of a form page, reusing the boxes of a known layout when the page matches one.
+
+    Parameters:
+        image, scale: See detect_structure
+        registry: LayoutRegistry to look the page up in and to add newly detected layouts to, or None
+
+    Returns:
+        tuple: As detect_structure. The lines are empty when the boxes come from the registry.
+    """
+    original = load_grayscale(image)
+    if registry is None:
+        return detect_structure(original, scale=scale)
+
+    signature = registry.signature(original)
+    if signature is not None:
+        boxes = registry.match(original, signature=signature)
+        if boxes is not None:
+            return original, [], [], boxes
+
+    original, horizontal_lines, vertical_lines, boxes = detect_structure(original, scale=scale)
+    if signature is not None:
+        registry.add(original, boxes, signature=signature)
+    return original, horizontal_lines, vertical_lines, boxes
+
+
+def detect_lines_and_boxes(image, cache_dir=None, batch_ocr=False, debug_dir=None, template_registry=None):
+    """
+    Detect the ruled boxes of a form page and OCR the text inside each box.
+
+    Parameters:
+        image: Page as accepted by load_grayscale, e.g. a grayscale array rendered from the PDF
+        cache_dir: OCR cache directory. Boxes whose pixels were already OCR'd are read from
+            the cache instead of running Tesseract. If None, caching is disabled.
+        batch_ocr: OCR the boxes in composite images with one Tesseract call each instead of
+            one call per box
+        debug_dir: Directory to write images of the detected lines (detected_lines_debug.jpg)
+            and boxes (annotated_form.jpg) to. If None, no images are written.
+        template_registry: Layout registry journal (JSONL). Pages matching a stored layout reuse its boxes
+            instead of running line detection; other pages are added to it. If None, every page
+            runs line detection.
+
+    Returns:
+        list: {'coordinates': (left, top, width, height), 'text': str} for each box
+    """
+    registry = get_layout_registry(template_registry)
+    original, horizontal_lines, vertical_lines, boxes = find_structure(image, registry=registry)
+    cache = get_ocr_cache(cache_dir)
+
+    results = ocr_boxes(original, boxes, cache=cache, batch=batch_ocr)
+
+    if debug_dir is not None:
+        write_debug_images(debug_dir, original, horizontal_lines, vertical_lines, boxes)
+    if cache is not None:
+        logger.debug("OCR cache: %s", cache.stats())
+    if registry is not None:
+        logger.debug("Layout registry: %s", registry.stats())
+    logger.debug("OCR engines: %s", get_engine_pool().stats())
+    return results
+
+
+def detect_lines_and_boxes_two_resolution(pdf_path, page_number, page, structure_dpi, dpi=REFERENCE_DPI,
+                                          cache_dir=None, batch_ocr=False, debug_dir=None, template_registry=None):
+    """
+    Detect the boxes of a page on a low resolution rendering and OCR them at full resolution.
+
+    The morphology, Hough transform and box search run on the page rendered at structure_dpi.
+    The boxes found are scaled to dpi, and only the region of the page holding them is rendered
+    again at dpi for OCR, in a single pdftoppm call.
+
+    Parameters:
+        pdf_path: Path of the PDF
+        page_number: 1-based number of the page in the PDF
+        page: The page rendered at structure_dpi, as accepted by load_grayscale
+        structure_dpi: Resolution page was rendered at
+        dpi: Resolution for OCR
+        cache_dir, batch_ocr, template_registry: See detect_lines_and_boxes
+        debug_dir: Directory for the debug images, which show the low resolution page
+
+    Returns:
+        list: {'coordinates': (left, top, width, height), 'text': str} for each box, in pixels at dpi
+    """
+    registry = get_layout_registry(template_registry)
+    original, horizontal_lines, vertical_lines, boxes = find_structure(page, scale=structure_dpi / REFERENCE_DPI,
+                                                                       registry=registry)
+    if debug_dir is not None:
+        write_debug_images(debug_dir, original, horizontal_lines, vertical_lines, boxes)
+    if not boxes:
+        return []
+
+    zoom = dpi / structure_dpi
+    boxes = [tuple(int(round(value * zoom)) for value in box) for box in boxes]
+
+    tops, lefts, bottoms, rights = zip(*boxes)
+    region_top = max(0, min(tops) - RENDER_PADDING)
+    region_left = max(0, min(lefts) - RENDER_PADDING)
+    region = render_pdf_region(pdf_path, page_number, dpi, region_left, region_top,
+                               max(rights) + RENDER_PADDING - region_left,
+                               max(bottoms) + RENDER_PADDING - region_top)
+
+    cache = get_ocr_cache(cache_dir)
+    results = ocr_boxes(region, boxes, cache=cache, batch=batch_ocr, offset=(region_left, region_top))
+    if cache is not None:
+        logger.debug("OCR cache: %s", cache.stats())
+    if registry is not None:
+        logger.debug("Layout registry: %s", registry.stats())
+    logger.debug("OCR engines: %s", get_engine_pool().stats())
+    return results
+
+
+def render_pdf_region(pdf_path, page_number, dpi, left, top, width, height):
+    """
+    Render a region of a PDF page to a grayscale array with pdftoppm's crop options.
+
+    Parameters:
+        pdf_path: Path of the PDF
+        page_number: 1-based number of the page
+        dpi: Rendering resolution
+        left, top, width, height: Region to render, in pixels at dpi
+
+    Returns:
+        numpy.ndarray: The grayscale region
+    """
+    command = ['pdftoppm', '-f', str(page_number), '-l', str(page_number), '-r', str(dpi),
+               '-x', str(left), '-y', str(top), '-W', str(width), '-H', str(height),
+               '-gray', '-singlefile', pdf_path]
+    try:
+        result = subprocess.run(command, capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise ValueError(f"Error rendering page {page_number} of {pdf_path}: {e}")
+    region = cv2.imdecode(np.frombuffer(result.stdout, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if region is None:
+        raise ValueError(f"pdftoppm returned no image for page {page_number} of {pdf_path}")
+    return region
+
+
+def ocr_boxes(image, boxes, cache=None, batch=False, offset=(0, 0)):
+    """
+    OCR the boxes of a page.
+
+    Parameters:
+        image: Grayscale page, or the region of the page starting at offset
+        boxes: (top, left, bottom, right) of each box in page coordinates
+        cache, batch: See ocr_rois
+        offset: (left, top) position of image on the page
+
+    Returns:
+        list: {'coordinates': (left, top, width, height), 'text': str} for each box
+    """
+    offset_left, offset_top = offset
+
+    # Extract and process the ROI of each box
+    coordinates = []
+    rois = []
+    for box in boxes:
+        top, left, bottom, right = map(int, box)  # Ensure integer coordinates
+
+        roi = image[top - offset_top:bottom - offset_top, left - offset_left:right - offset_left]
+        roi_gray = cv2.convertScaleAbs(roi, alpha=1.5, beta=0)
+
+        coordinates.append((left, top, right, bottom))
+        rois.append(roi_gray)
+
+    # OCR processing
+    texts = ocr_rois(rois, cache=cache, batch=batch)
+
+    # Process boxes to create results
+    results = []
+    for (left, top, right, bottom), text in zip(coordinates, texts):
+        results.append({
+            'coordinates': (left, top, right - left, bottom - top),
+            'text': text
+        })
+    return results
+
+
+def write_debug_images(debug_dir, page, horizontal_lines, vertical_lines, boxes):
+    """Write the detected lines (detected_lines_debug.jpg) and boxes (annotated_form.jpg) of a page."""
+    os.makedirs(debug_dir, exist_ok=True)
+
+    # Draw lines for debugging (your existing visualization code)
+    debug_img = cv2.cvtColor(page, cv2.COLOR_GRAY2BGR)
+    for line in horizontal_lines:
+        x1, y1, x2, y2 = map(int, line)
+        cv2.line(debug_img, (x1, y1), (x2, y2), (255, 0, 0), 2)
+    for line in vertical_lines:
+        x1, y1, x2, y2 = map(int, line)
+        cv2.line(debug_img, (x1, y1), (x2, y2), (0, 255, 0), 2)
+    cv2.imwrite(os.path.join(debug_dir, 'detected_lines_debug.jpg'), debug_img)
+
+    annotated = cv2.cvtColor(page, cv2.COLOR_GRAY2BGR)
+    for top, left, bottom, right in boxes:
+        cv2.rectangle(annotated, (int(left), int(top)), (int(right), int(bottom)), (0, 255, 0), 2)
+    cv2.imwrite(os.path.join(debug_dir, 'annotated_form.jpg'), annotated)
+
+
+def ocr_rois(rois, cache=None, batch=False):
+    """
+    OCR a list of box images.
+
+    Parameters:
+        rois: Grayscale box images as numpy arrays
+        cache: OcrCache to read and store results in, or None
+        batch: Pack the boxes into composite images and OCR each composite with a single
+            Tesseract call instead of one call per box
+
+    Returns:
+        list: Stripped text of each box, in the order of rois
+    """
+    texts = [None] * len(rois)
+    cache_keys = [None] * len(rois)
+    if cache is not None:
+        # The composite images can read a box differently, so the two modes are cached apart
+        kind = "image_to_string_batched" if batch else "image_to_string"
+        for i, roi in enumerate(rois):
+            cache_keys[i] = cache.key(roi, config=BOX_OCR_CONFIG, kind=kind)
+            texts[i] = cache.get(cache_keys[i])
+
+    missing = [i for i, text in enumerate(texts) if text is None]
+    if batch:
+        batch_texts = ocr_rois_batched([rois[i] for i in missing])
+    else:
+        engines = get_engine_pool()
+        batch_texts = [engines.image_to_string(rois[i], config=BOX_OCR_CONFIG).strip() for i in missing]
+
+    for i, text in zip(missing, batch_texts):
+        texts[i] = text
+        if cache is not None:
+            cache.put(cache_keys[i], text)
+    return texts
+
 
-    return lines, img
+def ocr_rois_batched(rois, max_height=BATCH_MAX_HEIGHT, gap=BATCH_GAP):
+    """
+    OCR many box images with one Tesseract call per composite image.
+
+    The boxes are stacked top to bottom on a white canvas, separated by `gap` pixels so
+    Tesseract never joins lines across boxes. Each recognized word is mapped back to the
+    box whose slot contains the vertical center of the word.
+
+    Parameters:
+        rois: Grayscale box images as numpy arrays
+        max_height: Maximum height of a composite image; boxes are split into several
+            composites if needed
+        gap: White space between stacked boxes
+
+    Returns:
+        list: Text of each box, with words joined by spaces and lines by newlines
+    """
+    texts = [""] * len(rois)
+
+    # Split the boxes into composites no taller than max_height
+    batches = []
+    current = []
+    height = gap
+    for i, roi in enumerate(rois):
+        if current and height + roi.shape[0] + gap > max_height:
+            batches.append(current)
+            current = []
+            height = gap
+        current.append(i)
+        height += roi.shape[0] + gap
+    if current:
+        batches.append(current)
+
+    for batch in batches:
+        width = max(rois[i].shape[1] for i in batch) + 2 * gap
+        height = gap + sum(rois[i].shape[0] + gap for i in batch)
+        composite = np.full((height, width), 255, dtype=np.uint8)
+
+        # Paste the boxes and remember where each one starts
+        slot_tops = []
+        slot_bottoms = []
+        y = gap
+        for i in batch:
+            roi_height, roi_width = rois[i].shape[:2]
+            composite[y:y + roi_height, gap:gap + roi_width] = rois[i]
+            slot_tops.append(y)
+            slot_bottoms.append(y + roi_height)
+            y += roi_height + gap
+        slot_tops = np.array(slot_tops)
+        slot_bottoms = np.array(slot_bottoms)
+
+        data = get_engine_pool().image_to_data(composite, config=BOX_OCR_CONFIG)
+        words = data[data["text"].notnull()].copy()
+        words["text"] = words["text"].astype(str).str.strip()
+        words = words[words["text"] != ""]
+        if words.empty:
+            continue
+
+        # Map each word to the slot containing its vertical center
+        centers = (words["top"] + words["height"] / 2).to_numpy()
+        slots = np.searchsorted(slot_tops, centers, side='right') - 1
+        inside = (slots >= 0) & (centers < slot_bottoms[np.clip(slots, 0, None)])
+        words = words[inside]
+        words["slot"] = slots[inside]
+
+        # Rows come back in reading order; rebuild each box's lines from them
+        for slot, slot_words in words.groupby("slot", sort=False):
+            lines = slot_words.groupby(["block_num", "par_num", "line_num"], sort=False)["text"]
+            texts[batch[slot]] = "\n".join(" ".join(line) for _, line in lines)
+
+    return texts
 
 
-def detect_lines_and_boxes(image_path):
-    edges, original = preprocess_image(image_path)
+def detect_line_segments(edges, threshold=50, min_line_length=100, max_line_gap=10):
+    """
+    Detect straight line segments in a line mask and split them by orientation.
+
+    Parameters:
+        edges: Binary image of the form's lines, as returned by preprocess_image
+        threshold, min_line_length, max_line_gap: Parameters of cv2.HoughLinesP
 
+    Returns:
+        tuple: (horizontal_lines, vertical_lines), each a list of [x1, y1, x2, y2]
+    """
     # Detect lines (this part stays the same)
     lines = cv2.HoughLinesP(
         edges,
         rho=1,
         theta=np.pi / 180,
-        threshold=50,
-        minLineLength=100,
-        maxLineGap=10
+        threshold=threshold,
+        minLineLength=min_line_length,
+        maxLineGap=max_line_gap
     )
 
     # Separate into horizontal and vertical lines
@@ -68,8 +519,7 @@ def detect_lines_and_boxes(image_path):
 
     # Track statistics (your existing statistics code stays here)
     if lines is not None:
-        for line in lines:
-            x1, y1, x2, y2 = line[0]
+        for x1, y1, x2, y2 in lines.reshape(-1, 4):
             dx = x2 - x1
             dy = y2 - y1
 
@@ -78,53 +528,10 @@ def detect_lines_and_boxes(image_path):
             elif abs(dx) < 5:  # Vertical
                 vertical_lines.append([x1, y1, x2, y2])
 
-    # Add form boundaries if missing
-    vertical_lines = ensure_form_boundaries(vertical_lines, horizontal_lines, original.shape)
-
-    # Merge nearby lines
-    horizontal_lines = merge_nearby_lines(horizontal_lines)
-    vertical_lines = merge_nearby_lines(vertical_lines)
-
-    # Draw lines for debugging (your existing visualization code)
-    debug_img = original.copy()
-    for line in horizontal_lines:
-        x1, y1, x2, y2 = map(int, line)
-        cv2.line(debug_img, (x1, y1), (x2, y2), (255, 0, 0), 2)
-    for line in vertical_lines:
-        x1, y1, x2, y2 = map(int, line)
-        cv2.line(debug_img, (x1, y1), (x2, y2), (0, 255, 0), 2)
-    cv2.imwrite('detected_lines_debug.jpg', debug_img)
+    return horizontal_lines, vertical_lines
 
-    # Find boxes using our intersection detection
-    boxes = find_boxes_from_lines(horizontal_lines, vertical_lines, original.shape)
 
-    # Process boxes to create results
-    results = []
-    for box in boxes:
-        top, left, bottom, right = map(int, box)  # Ensure integer coordinates
-
-        # Extract and process ROI
-        roi = original[top:bottom, left:right]
-        roi_gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-        roi_gray = cv2.convertScaleAbs(roi_gray, alpha=1.5, beta=0)
-
-        # OCR processing
-        roi_pil = Image.fromarray(roi_gray)
-        text = pytesseract.image_to_string(roi_pil, config=r'--oem 3 --psm 6').strip()
-
-        results.append({
-            'coordinates': (left, top, right - left, bottom - top),
-            'text': text
-        })
-
-        # Draw box on original image
-        cv2.rectangle(original, (left, top), (right, bottom), (0, 255, 0), 2)
-
-    cv2.imwrite('annotated_form.jpg', original)
-    return results
-
-
-def ensure_form_boundaries(vertical_lines, horizontal_lines, image_shape):
+def ensure_form_boundaries(vertical_lines, horizontal_lines, image_shape, tolerance=20):
     """
     Add form boundaries aligned with the extent of horizontal lines.
 
@@ -132,6 +539,8 @@ def ensure_form_boundaries(vertical_lines, horizontal_lines, image_shape):
     1. Find the leftmost and rightmost x-coordinates where horizontal lines start/end
     2. Place our vertical boundaries at those positions
     3. Make these boundaries span the full height of the form
+
+    A boundary is only added if no vertical line lies within tolerance pixels of it.
     """
     # Find the extent of horizontal lines
     min_x = float('inf')
@@ -143,8 +552,8 @@ def ensure_form_boundaries(vertical_lines, horizontal_lines, image_shape):
         max_x = max(max_x, x1, x2)
 
     # Check if we already have lines near these boundaries
-    left_edge_exists = any(abs(line[0] - min_x) < 20 for line in vertical_lines)
-    right_edge_exists = any(abs(line[0] - max_x) < 20 for line in vertical_lines)
+    left_edge_exists = any(abs(line[0] - min_x) < tolerance for line in vertical_lines)
+    right_edge_exists = any(abs(line[0] - max_x) < tolerance for line in vertical_lines)
 
     if not left_edge_exists:
         # Add left boundary at the start of horizontal lines
@@ -180,103 +589,170 @@ def do_lines_intersect(h_line, v_line):
     return x_overlaps and y_overlaps
 
 
-def find_boxes_from_lines(horizontal_lines, vertical_lines, original_shape):
+def find_boxes_from_lines(horizontal_lines, vertical_lines, original_shape, debug=False, min_width=30,
+                          min_height=20, span_tolerance=0):
     """
     Find boxes by examining how lines interact to form the form's structure.
     Each line can participate in forming multiple boxes - this is how actual forms work.
 
+    A box is formed by each pair of adjacent horizontal lines together with each pair of
+    adjacent vertical lines that span both of them. Instead of scanning every vertical line
+    for every pair of horizontal lines, each vertical line looks up the horizontal lines it
+    spans with a binary search of its endpoints in the sorted y-coordinates. Those form a
+    contiguous run, so the line spans every pair of adjacent horizontal lines within the run,
+    and the work grows with the number of (pair, vertical line) spans rather than H x V.
+
     Parameters:
         horizontal_lines: List of [x1, y1, x2, y2] horizontal line segments
         vertical_lines: List of [x1, y1, x2, y2] vertical line segments
         original_shape: Shape of the original image for size validation
-    """
-    boxes = []
+        debug: Print the boxes found
+        min_width, min_height: Smallest box kept, in pixels
+        span_tolerance: Pixels a vertical line may fall short of a horizontal line and still span it
 
+    Returns:
+        list: (top, left, bottom, right) of each box, top to bottom and left to right
+    """
     # Sort lines by their position to make processing logical
     # For horizontal lines, sort by y-coordinate (top to bottom)
     # For vertical lines, sort by x-coordinate (left to right)
     horizontal_lines.sort(key=lambda x: x[1])
     vertical_lines.sort(key=lambda x: x[0])
 
-    print(f"\nProcessing lines to find boxes:")
-    print(f"Found {len(horizontal_lines)} horizontal lines")
-    print(f"Found {len(vertical_lines)} vertical lines")
-
-    # For each pair of horizontal lines (potential top and bottom of boxes)
-    for i in range(len(horizontal_lines) - 1):
-        h1 = horizontal_lines[i]  # Upper horizontal line
-        h2 = horizontal_lines[i + 1]  # Lower horizontal line
-        h1_y = h1[1]  # y-coordinate of upper line
-        h2_y = h2[1]  # y-coordinate of lower line
-
-        # Find all vertical lines that intersect with both these horizontal lines
-        valid_verticals = []
-        for v_line in vertical_lines:
-            v_x = v_line[0]  # x-coordinate of vertical line
-            v_top = min(v_line[1], v_line[3])
-            v_bottom = max(v_line[1], v_line[3])
-
-            # Check if this vertical line spans between our horizontal lines
-            if v_top <= h1_y <= v_bottom and v_top <= h2_y <= v_bottom:
-                valid_verticals.append(v_line)
-
-        # Now look at each pair of adjacent vertical lines that are valid
-        if len(valid_verticals) >= 2:
-            for j in range(len(valid_verticals) - 1):
-                v1 = valid_verticals[j]  # Left vertical line
-                v2 = valid_verticals[j + 1]  # Right vertical line
-
-                # Create a box from these four lines
-                left = min(v1[0], v1[2])
-                right = max(v2[0], v2[2])
-                top = h1_y
-                bottom = h2_y
-
-                width = right - left
-                height = bottom - top
-
-                # Filter boxes by size to avoid noise and invalid detections
-                if (width > 30 and height > 20):
-                    print(f"Found valid box:")
-                    print(f"  Position: top={top}, left={left}, bottom={bottom}, right={right}")
-                    print(f"  Size: {width}x{height} pixels")
-
-                    boxes.append((int(top), int(left), int(bottom), int(right)))
-
-    print(f"\nBox Detection Complete:")
-    print(f"Total boxes found: {len(boxes)}")
+    if debug:
+        print(f"\nProcessing lines to find boxes:")
+        print(f"Found {len(horizontal_lines)} horizontal lines")
+        print(f"Found {len(vertical_lines)} vertical lines")
+
+    if len(horizontal_lines) < 2 or len(vertical_lines) < 2:
+        return []
+
+    h_y = np.array([line[1] for line in horizontal_lines], dtype=float)
+    v = np.array(vertical_lines, dtype=float).reshape(-1, 4)
+    v_top = np.minimum(v[:, 1], v[:, 3]) - span_tolerance
+    v_bottom = np.maximum(v[:, 1], v[:, 3]) + span_tolerance
+
+    # Vertical line k spans horizontal lines first[k] .. last[k] - 1, so it spans the pairs
+    # (i, i + 1) of rows first[k] .. last[k] - 2
+    first = np.searchsorted(h_y, v_top, side='left')
+    last = np.searchsorted(h_y, v_bottom, side='right')
+    counts = np.maximum(last - first - 1, 0)
+    cols = np.repeat(np.arange(len(v)), counts)
+    rows = first[cols] + np.arange(len(cols)) - np.repeat(np.cumsum(counts) - counts, counts)
+    # Row by row, and left to right within a row since the vertical lines are sorted by x
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+
+    # Adjacent valid verticals in the same row form the left and right of a box
+    pair = rows[:-1] == rows[1:]
+    rows, left_cols, right_cols = rows[:-1][pair], cols[:-1][pair], cols[1:][pair]
+
+    top = h_y[rows]
+    bottom = h_y[rows + 1]
+    left = np.minimum(v[left_cols, 0], v[left_cols, 2])
+    right = np.maximum(v[right_cols, 0], v[right_cols, 2])
+
+    # Filter boxes by size to avoid noise and invalid detections
+    valid = ((right - left) > min_width) & ((bottom - top) > min_height)
+    boxes = [(int(t), int(l), int(b), int(r)) for t, l, b, r in
+             zip(top[valid].tolist(), left[valid].tolist(), bottom[valid].tolist(), right[valid].tolist())]
+
+    if debug:
+        for t, l, b, r in zip(top[valid], left[valid], bottom[valid], right[valid]):
+            print(f"Found valid box:")
+            print(f"  Position: top={t}, left={l}, bottom={b}, right={r}")
+            print(f"  Size: {r - l}x{b - t} pixels")
+        print(f"\nBox Detection Complete:")
+        print(f"Total boxes found: {len(boxes)}")
 
     return boxes
 
 
 def merge_nearby_lines(lines, threshold=20):
-    """Merge lines that are close and parallel"""
-    if not lines:
+    """
+    Merge lines that are close and parallel.
+
+    Gives the same groups as comparing every pair of lines with are_lines_similar: each line
+    not yet merged, in input order, seeds a group of the remaining lines similar to it.
+    Instead of testing every pair, candidates are found by sorting the lines on their offset
+    (y for horizontal lines, x for vertical lines) and sweeping a window of the threshold
+    around each seed; the angle and distance tests then run on the whole window at once.
+
+    Parameters:
+        lines: List of lines in [x1, y1, x2, y2] format
+        threshold: Maximum pixel distance to consider lines for merging
+
+    Returns:
+        list: Merged lines in [x1, y1, x2, y2] format
+    """
+    if len(lines) == 0:
         return []
 
+    coords = np.asarray(lines, dtype=float).reshape(-1, 4)
+    x1, y1, x2, y2 = coords.T
+    angles = np.arctan2(y2 - y1, x2 - x1) * 180 / np.pi
+    abs_angles = np.abs(angles)
+
+    # Seeds below 45 or above 135 degrees are compared on y, the others on x. Similar lines
+    # are within 5 degrees of their seed, so each pool also holds lines just past that split.
+    seed_is_horizontal = (abs_angles < 45) | (abs_angles > 135)
+    horizontal_pool = _LineSweep(np.flatnonzero((abs_angles < 50) | (abs_angles > 130)),
+                                 np.minimum(y1, y2), np.maximum(y1, y2))
+    vertical_pool = _LineSweep(np.flatnonzero((abs_angles >= 40) & (abs_angles <= 140)),
+                               np.minimum(x1, x2), np.maximum(x1, x2))
+
     merged = []
-    used = set()
+    used = np.zeros(len(coords), dtype=bool)
 
-    for i, line1 in enumerate(lines):
-        if i in used:
+    for i in range(len(coords)):
+        if used[i]:
             continue
+        used[i] = True
+
+        if seed_is_horizontal[i]:
+            candidates = horizontal_pool.window(i, threshold)
+            seed_ends, candidate_ends = (y1[i], y2[i]), (y1[candidates], y2[candidates])
+        else:
+            candidates = vertical_pool.window(i, threshold)
+            seed_ends, candidate_ends = (x1[i], x2[i]), (x1[candidates], x2[candidates])
+
+        # Lines must have similar angles (within 5 degrees, allowing for wrapping around 360)
+        angle_diff = np.abs(angles[i] - angles[candidates])
+        parallel = (angle_diff <= 5) | (angle_diff >= 355)
+
+        # ... and some pair of endpoints closer than the threshold
+        distance = np.minimum.reduce([np.abs(seed_end - candidate_end)
+                                      for seed_end in seed_ends for candidate_end in candidate_ends])
+        similar = candidates[parallel & (distance < threshold) & ~used[candidates]]
+        similar.sort()
+        used[similar] = True
 
-        current_group = [line1]
-        used.add(i)
+        # Merge lines in the group
+        merged.append(merge_line_group([lines[i]] + [lines[j] for j in similar]))
 
-        for j, line2 in enumerate(lines):
-            if j in used:
-                continue
+    return merged
 
-            # Check if lines are parallel and close
-            if are_lines_similar(line1, line2, threshold):
-                current_group.append(line2)
-                used.add(j)
 
-        # Merge lines in the group
-        merged.append(merge_line_group(current_group))
+class _LineSweep:
+    """
+    Lines of one orientation sorted by the low end of their offset range, for finding the
+    lines that may lie within a threshold of a given line without comparing against all of them.
+    """
 
-    return merged
+    def __init__(self, indices, low, high):
+        self.low = low
+        self.high = high
+        order = np.argsort(low[indices], kind='stable')
+        self.indices = indices[order]
+        self.sorted_low = low[self.indices]
+        # No line extends further than this past its low end
+        self.max_span = float((high[indices] - low[indices]).max()) if len(indices) else 0.0
+
+    def window(self, i, threshold):
+        """Indices of lines whose offset range comes within threshold of line i's."""
+        start = np.searchsorted(self.sorted_low, self.low[i] - threshold - self.max_span, side='left')
+        stop = np.searchsorted(self.sorted_low, self.high[i] + threshold, side='right')
+        return self.indices[start:stop]
 
 
 def are_lines_similar(line1, line2, threshold=20):
@@ -357,37 +833,59 @@ def merge_line_group(lines):
         return [avg_x, top_point[1], avg_x, bottom_point[1]]
 
 
-def process_pdf(pdf_path, output_dir):
-    """Process entire PDF"""
-    # Extract pages to TIFF
-    tiff_files = extract_pdf_pages(pdf_path, os.path.join(output_dir, 'tiff_pages'))
+def process_pdf(pdf_path, output_dir, cache_dir=None, batch_ocr=False, max_pages=None, dpi=REFERENCE_DPI,
+                save_tiff=False, debug=False, structure_dpi=None, template_registry=None):
+    """
+    Process entire PDF
+
+    Pages are rendered straight to grayscale arrays and handed to detect_lines_and_boxes in
+    memory, one page at a time. With structure_dpi, pages are rendered at that resolution for
+    line and box detection, and only the region holding the boxes is rendered at dpi for OCR
+    (see detect_lines_and_boxes_two_resolution).
 
-    # Create directory for results
+    Parameters:
+        pdf_path: Path of the PDF
+        output_dir: Directory for the optional artifacts
+        cache_dir, batch_ocr, template_registry: See detect_lines_and_boxes
+        max_pages: Process only the first max_pages pages. If None, all pages are processed.
+        dpi: Rendering resolution
+        save_tiff: Also save each page as rendered (at structure_dpi in two-resolution mode) as
+            output_dir/tiff_pages/page_<n>.tiff
+        debug: Write the line and box images of each page to output_dir/results/page_<n>/
+        structure_dpi: Resolution for line and box detection, e.g. 100. If None or not below
+            dpi, everything runs on the page rendered at dpi.
+
+    Returns:
+        dict: Results of detect_lines_and_boxes keyed by 'page_<n>'
+    """
+    page_count = pdfinfo_from_path(pdf_path)["Pages"]
+    if max_pages is not None:
+        page_count = min(page_count, max_pages)
+
+    tiff_dir = os.path.join(output_dir, 'tiff_pages')
+    if save_tiff:
+        os.makedirs(tiff_dir, exist_ok=True)
     results_dir = os.path.join(output_dir, 'results')
-    os.makedirs(results_dir, exist_ok=True)
 
     # Process each page
+    two_resolution = structure_dpi is not None and structure_dpi < dpi
     all_results = {}
-    for tiff_file in tiff_files[:1]:
-
-        original_bounds = get_image_bounds(tiff_file)
-        # print("Original image bounds:")
-        # print(f"Width x Height: {original_bounds['width']} x {original_bounds['height']}")
-        # print(f"Top: {original_bounds['top']}")
-        # print(f"Left: {original_bounds['left']}")
-        # print(f"Bottom: {original_bounds['bottom']}")
-        # print(f"Right: {original_bounds['right']}")
-
-        page_num = os.path.basename(tiff_file).split('_')[1].split('.')[0]
-        results = detect_lines_and_boxes(tiff_file)
+    pages = iter_pdf_pages(pdf_path, page_count, dpi=structure_dpi if two_resolution else dpi, grayscale=True)
+    for page_num, page in enumerate(pages, start=1):
+        if save_tiff:
+            page.save(os.path.join(tiff_dir, f'page_{page_num}.tiff'), 'TIFF')
+
+        debug_dir = os.path.join(results_dir, f'page_{page_num}') if debug else None
+        if two_resolution:
+            results = detect_lines_and_boxes_two_resolution(pdf_path, page_num, load_grayscale(page), structure_dpi,
+                                                            dpi=dpi, cache_dir=cache_dir, batch_ocr=batch_ocr,
+                                                            debug_dir=debug_dir, template_registry=template_registry)
+        else:
+            results = detect_lines_and_boxes(load_grayscale(page), cache_dir=cache_dir, batch_ocr=batch_ocr,
+                                             debug_dir=debug_dir, template_registry=template_registry)
 
         all_results[f'page_{page_num}'] = results
 
-        # Rename output files to include page number
-        if os.path.exists('annotated_form.jpg'):
-            os.rename('annotated_form.jpg',
-                      os.path.join(results_dir, f'annotated_page_{page_num}.jpg'))
-
     return all_results
 
 
@@ -421,9 +919,13 @@ def get_annotation_bounds(boxes):
         'height': max_y - min_y
     }
 
-def get_image_bounds(image_path):
-    img = cv2.imread(image_path)
-    height, width = img.shape[:2]
+def get_image_bounds(image):
+    if isinstance(image, str):
+        height, width = load_grayscale(image).shape[:2]
+    elif isinstance(image, Image.Image):
+        width, height = image.size
+    else:
+        height, width = image.shape[:2]
     return {
         'top': 0,
         'left': 0,
@@ -509,12 +1011,12 @@ def write_results_to_csv(all_results, output_dir):
     return csv_filename
 
 
-# Usage
-pdf_path = "/home/don/Documents/Temp/WW990/files_failing/010211547_202212_990PF_2023120422057614.pdf"
-output_dir = '/home/don/Documents/Temp/WW990/processed_forms'
-results_csv = os.path.join(output_dir, 'results.csv')
-results = process_pdf(pdf_path, output_dir)
-write_results_to_csv(results, output_dir)
+if __name__ == "__main__":
+    pdf_path = "/home/don/Documents/Temp/WW990/files_failing/010211547_202212_990PF_2023120422057614.pdf"
+    output_dir = '/home/don/Documents/Temp/WW990/processed_forms'
+    results_csv = os.path.join(output_dir, 'results.csv')
+    results = process_pdf(pdf_path, output_dir, max_pages=1, debug=True)
+    write_results_to_csv(results, output_dir)
 
 
 
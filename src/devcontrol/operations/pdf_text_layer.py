@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import subprocess
+import xml.etree.ElementTree as ET
+
+import pandas as pd
+from pdf2image import convert_from_path
+
+from operations.pdf_to_text_boxes import ocr_page
+from utils import temp_file_rw as temp_mgr
+from utils.ocr_engine import TSV_COLUMNS
+
+XHTML_NS = "{http://www.w3.org/1999/xhtml}"
+
+# PDF coordinates are in points
+POINTS_PER_INCH = 72
+
+# Confidence given to words taken from the text layer, on Tesseract's 0-100 scale
+TEXT_LAYER_CONF = 100.0
+
+
+def read_text_layer(pdf_path, dpi=300):
+    """
+    Reads the words of a PDF's embedded text layer with poppler's pdftotext -bbox-layout.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+        dpi (int): Resolution the coordinates are converted to, so they match an OCR of the page
+            rendered at that resolution.
+
+    Returns:
+        list: One DataFrame per page with the columns of Tesseract's image_to_data output (one row
+            per word, level 5). Pages without a text layer give an empty DataFrame.
+    """
+    try:
+        result = subprocess.run(["pdftotext", "-bbox-layout", pdf_path, "-"], capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise ValueError(f"Error reading the text layer of {pdf_path}: {e}")
+
+    scale = dpi / POINTS_PER_INCH
+    pages = []
+    root = ET.fromstring(result.stdout)
+    for page_num, page in enumerate(root.iter(f"{XHTML_NS}page"), start=1):
+        rows = []
+        # pdftotext groups words as flow > block > line > word; Tesseract as block > par > line > word
+        for block_num, block in enumerate(page.iter(f"{XHTML_NS}block"), start=1):
+            for line_num, line in enumerate(block.iter(f"{XHTML_NS}line"), start=1):
+                for word_num, word in enumerate(line.iter(f"{XHTML_NS}word"), start=1):
+                    text = (word.text or "").strip()
+                    if not text:
+                        continue
+                    left = round(float(word.get("xMin")) * scale)
+                    top = round(float(word.get("yMin")) * scale)
+                    right = round(float(word.get("xMax")) * scale)
+                    bottom = round(float(word.get("yMax")) * scale)
+                    rows.append([5, page_num, block_num, 1, line_num, word_num,
+                                 left, top, right - left, bottom - top, TEXT_LAYER_CONF, text])
+        pages.append(pd.DataFrame(rows, columns=TSV_COLUMNS))
+    return pages
+
+
+def extract_text_from_pdf(input_path, output_dir=None, dpi=300, min_words=5, cache_dir=None):
+    """
+    Extracts text and bounding boxes from a PDF, using its text layer where it has one.
+
+    E-filed returns carry their text, so those pages are read without rendering or OCR. Pages
+    with fewer than min_words words in the text layer (scanned pages) are rendered and OCR'd.
+    The result has the same structure as extract_text_from_image, so identify_form_elements
+    can follow either.
+
+    Args:
+        input_path (str): Path to the PDF file.
+        output_dir (str): Directory for the images of OCR'd pages and page_sources.json. If None,
+            uses the current directory.
+        dpi (int): Resolution of the coordinates, and of the pages rendered for OCR.
+        min_words (int): Pages with fewer words in the text layer are OCR'd.
+        cache_dir (str): Directory of the on-disk OCR cache for the OCR'd pages. If None, caching is disabled.
+
+    Returns:
+        str: Path to the temporary file containing the results, keyed by page index.
+    """
+    if output_dir is None:
+        output_dir = os.getcwd() + "/pdf_images"
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = {}
+    ocr_pages = []
+    for page_number, page_df in enumerate(read_text_layer(input_path, dpi=dpi)):
+        if len(page_df) >= min_words:
+            results[page_number] = page_df.to_dict()
+            continue
+
+        # Image-only page: render it and fall through to OCR
+        try:
+            image = convert_from_path(input_path, dpi=dpi, first_page=page_number + 1, last_page=page_number + 1)[0]
+        except Exception as e:
+            raise ValueError(f"Error converting PDF page {page_number + 1} to an image: {e}")
+        _, page_data, elapsed, cached = ocr_page(page_number, image, output_dir, cache_dir)
+        results[page_number] = page_data
+        ocr_pages.append(page_number)
+        logging.info("Page %s has no text layer, OCR took %.2fs%s", page_number, elapsed, " (cached)" if cached else "")
+
+    text_layer_pages = [page_number for page_number in results if page_number not in ocr_pages]
+    logging.info("%s: %s pages read from the text layer, %s OCR'd", input_path, len(text_layer_pages), len(ocr_pages))
+    with open(os.path.join(output_dir, "page_sources.json"), "w") as f:
+        json.dump({"text_layer": text_layer_pages, "ocr": ocr_pages}, f, indent=2)
+
+    return temp_mgr.write_to_temp_file(results)
@@ -2,20 +2,84 @@ import json
 import logging
 
 from pdf2image import convert_from_path
-import pytesseract
 import pandas as pd
 import os
 import svgwrite
 import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from utils import temp_file_rw as temp_mgr
+from utils.concurrency import bounded_map
+from utils.ocr_cache import get_ocr_cache
+from utils.ocr_engine import get_engine_pool
 
-def extract_text_from_image(images, output_dir=None):
+# Default prefix of the per-page CSV dumps written by identify_form_elements
+PAGE_CSV_PREFIX = "/home/don/Documents/Temp/WW990/structure/page_dfs/page"
+
+def ocr_page(page_number, image, output_dir, cache_dir=None):
+    """
+    Saves a single page image and runs Tesseract on it.
+
+    Runs in a worker process when pages are spread across a process pool, so it
+    only takes picklable arguments and returns plain data.
+
+    Args:
+        page_number (int): Index of the page within the document.
+        image (PIL.Image.Image): Rendered page.
+        output_dir (str): Directory to save the page image in.
+        cache_dir (str): OCR cache directory. If None, Tesseract always runs.
+
+    Returns:
+        tuple: (page_number, OCR results as a dict, wall time in seconds, True if served from the cache)
+    """
+    start = time.perf_counter()
+
+    # Save image to output directory
+    image_path = os.path.join(output_dir, f"page_{page_number}.png")
+    image.save(image_path, "PNG")
+
+    cache = get_ocr_cache(cache_dir)
+    if cache is not None:
+        cache_key = cache.key(image, config="", kind="image_to_data")
+        page_data = cache.get(cache_key)
+        if page_data is not None:
+            return page_number, page_data, time.perf_counter() - start, True
+
+    # Perform OCR with Tesseract to extract text and bounding boxes
+    ocr_data = get_engine_pool().image_to_data(image)
+
+    # Filter out empty rows
+    ocr_data = ocr_data[ocr_data["text"].notnull() & (ocr_data["text"].str.strip() != "")]
+    page_data = ocr_data.to_dict()
+
+    if cache is not None:
+        cache.put(cache_key, page_data)
+
+    return page_number, page_data, time.perf_counter() - start, False
+
+
+def _collect_pages(futures, results, page_times, cache_hits):
+    """Stores the results of finished page OCR futures."""
+    for future in futures:
+        page_number, page_data, elapsed, cached = future.result()
+        results[page_number] = page_data
+        page_times[page_number] = elapsed
+        if cached:
+            cache_hits.add(page_number)
+
+
+def extract_text_from_image(images, output_dir=None, workers=None, cache_dir=None):
     """
     Extracts text and bounding boxes from images using Tesseract.
 
     Args:
-        images (list): Images representing sections or pages of a 990PF
+        images (iterable): Images representing sections or pages of a 990PF. May be a generator, in which
+            case pages are consumed as they are rendered.
         output_dir (str): Directory to save the extracted images and TSV files. If None, uses the current directory.
+        workers (int): Number of worker processes used to OCR pages in parallel. If None or 1, pages are
+            processed one after another in the current process.
+        cache_dir (str): Directory of the on-disk OCR cache. Pages whose pixels were already OCR'd are read
+            from the cache instead of running Tesseract. If None, caching is disabled.
 
     Returns:
         str: Path to the temporary file containing the OCR results.
@@ -31,60 +95,88 @@ def extract_text_from_image(images, output_dir=None):
     # images = convert_from_path(pdf_path, dpi=300)
 
     results = {}
-
-    for page_number, image in enumerate(images, start=0):
-        # Save image to output directory
-        image_path = os.path.join(output_dir, f"page_{page_number}.png")
-        image.save(image_path, "PNG")
-
-        # Perform OCR with Tesseract to extract text and bounding boxes
-        logging.info(f"Processing page {page_number}...")
-        ocr_data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DATAFRAME)
-
-        # Filter out empty rows
-        ocr_data = ocr_data[ocr_data["text"].notnull() & (ocr_data["text"].str.strip() != "")]
-
-        # Store results in dictionary
-        results[page_number] = ocr_data.to_dict()
+    page_times = {}
+    cache_hits = set()
+    start = time.perf_counter()
+
+    if workers is None or workers <= 1:
+        for page_number, image in enumerate(images, start=0):
+            logging.info("Processing page %s...", page_number)
+            _, page_data, elapsed, cached = ocr_page(page_number, image, output_dir, cache_dir)
+            results[page_number] = page_data
+            page_times[page_number] = elapsed
+            if cached:
+                cache_hits.add(page_number)
+    else:
+        logging.info("Processing pages with %s worker processes...", workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Bound the number of pages in flight so a streamed document is never fully held in memory
+            def submit(page):
+                return executor.submit(ocr_page, *page, output_dir, cache_dir)
+
+            finished = bounded_map(submit, enumerate(images, start=0), 2 * workers)
+            _collect_pages((future for _, future in finished), results, page_times, cache_hits)
+        # Keep pages in document order regardless of completion order
+        results = {page_number: results[page_number] for page_number in sorted(results)}
+
+    total_time = time.perf_counter() - start
+    for page_number in sorted(page_times):
+        logging.info("Page %s OCR took %.2fs", page_number, page_times[page_number])
+    logging.info("OCR of %s pages took %.2fs (%.2fs of page time, workers=%s)",
+                 len(page_times), total_time, sum(page_times.values()), workers or 1)
+    if workers is None or workers <= 1:
+        logging.info("OCR engines: %s", get_engine_pool().stats())
+    if cache_dir is not None:
+        logging.info("OCR cache: %s hits, %s misses", len(cache_hits), len(page_times) - len(cache_hits))
+
+    # Record per-page timings alongside the page images
+    with open(os.path.join(output_dir, "page_timings.json"), "w") as f:
+        json.dump({"workers": workers or 1, "total_seconds": total_time, "pages": page_times,
+                   "cache_hits": sorted(cache_hits)}, f, indent=2)
 
     temp_file_path = temp_mgr.write_to_temp_file(results)
     logging.info(f"process_pdf complete")
     return temp_file_path
 
-def identify_form_elements(temp_file_path):
+def identify_form_elements(temp_file_path, csv_prefix=PAGE_CSV_PREFIX):
     """
     Analyzes OCR results to find form elements (titles and values) based on spatial consistency.
 
     Args:
         temp_file_path (str): Path to the temporary file containing OCR results.
+        csv_prefix (str): Prefix of the per-page CSV dumps of the OCR data; page N is written to
+            '<csv_prefix>N.csv'. If None, no CSV files are written.
 
     Returns:
         str: Path to the temporary file containing identified form elements.
     """
     ocr_data = temp_mgr.read_from_temp_file(temp_file_path)
-    outpath = "/home/don/Documents/Temp/WW990/structure/page_dfs/page"
-    # ocr_data = temp_file_path
     form_elements = []
 
     for page_number, page_data in ocr_data.items():
         page_df = pd.DataFrame(page_data)
-
-        # Group by block and line to identify clusters of text
-        grouped = page_df.groupby(['block_num', 'line_num'])
-
-        for (block_num, line_num), group in grouped:
-            group = group.sort_values(by='left')  # Sort text by horizontal position
-
-            # Concatenate text in the line to form potential titles or labels
-            line_text = " ".join(group['text'].tolist())
-
-            # Calculate the bounding box for the entire line
-            x_min = group['left'].min()
-            y_min = group['top'].min()
-            x_max = (group['left'] + group['width']).max()
-            y_max = (group['top'] + group['height']).max()
-
-            # Store the line as a potential form element
+        if page_df.empty:
+            continue
+
+        # Group by block and line to identify clusters of text, with the words of each line
+        # in horizontal order, and aggregate every line of the page at once
+        lines = (
+            page_df.assign(text=page_df['text'].astype(str),
+                           right=page_df['left'] + page_df['width'],
+                           bottom=page_df['top'] + page_df['height'])
+            .sort_values(by=['block_num', 'line_num', 'left'], kind='stable')
+            .groupby(['block_num', 'line_num'], sort=True)
+            .agg(text=('text', " ".join),
+                 x_min=('left', 'min'),
+                 y_min=('top', 'min'),
+                 x_max=('right', 'max'),
+                 y_max=('bottom', 'max'))
+        )
+
+        # Store each line as a potential form element
+        for line_text, x_min, y_min, x_max, y_max in zip(lines['text'].tolist(),
+                                                         lines['x_min'].tolist(), lines['y_min'].tolist(),
+                                                         lines['x_max'].tolist(), lines['y_max'].tolist()):
             form_elements.append({
                 'text': line_text,
                 'bounding_box': {
@@ -95,8 +187,9 @@ def identify_form_elements(temp_file_path):
                 },
                 'page': page_number
             })
-            of = outpath + str(page_number) + ".csv"
-            page_df.to_csv(of, index=True)
+
+        if csv_prefix is not None and not lines.empty:
+            page_df.to_csv(csv_prefix + str(page_number) + ".csv", index=True)
 
     return temp_mgr.write_to_temp_file(form_elements)
 
@@ -0,0 +1,137 @@
+import hashlib
+import importlib
+import json
+import logging
+import os
+import pickle
+
+from utils import temp_file_rw as temp_mgr
+from utils.io_utils import atomic_write
+
+logger = logging.getLogger("application")
+
+
+def fingerprint_input(data):
+    """
+    Fingerprints the raw input of a pipeline run.
+
+    Paths to existing files are fingerprinted by path, size and modification time rather than by
+    content, so large inputs are not read just to decide whether a checkpoint is still valid.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    if isinstance(data, str) and os.path.exists(data):
+        stat = os.stat(data)
+        digest.update(f"path|{os.path.abspath(data)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    else:
+        digest.update(json.dumps(data, sort_keys=True, default=repr).encode())
+    return digest.hexdigest()
+
+
+def module_version(module_name, pkg='operations'):
+    """
+    Returns a version string for an operation module.
+
+    Uses the module's __version__ if it defines one, otherwise a hash of its source file, so editing
+    an operation invalidates the checkpoints of the steps that use it.
+    """
+    module = importlib.import_module(pkg + '.' + module_name)
+    version = getattr(module, "__version__", None)
+    if version is not None:
+        return str(version)
+    source_file = getattr(module, "__file__", None)
+    if source_file is None or not os.path.isfile(source_file):
+        return "unknown"
+    with open(source_file, "rb") as file:
+        return hashlib.blake2b(file.read(), digest_size=20).hexdigest()
+
+
+def step_fingerprint(input_fingerprint, step):
+    """
+    Fingerprints the output of a step from its input fingerprint, its configuration and the version
+    of its operation's module.
+
+    Step outputs are deterministic functions of these, so the fingerprint of one step is the input
+    fingerprint of the next and the whole chain can be computed without touching any data.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(input_fingerprint.encode())
+    digest.update(json.dumps(step.config, sort_keys=True, default=repr).encode())
+    if not step.skip_step:
+        digest.update(module_version(step.module).encode())
+    if step.explicit_input:
+        digest.update(fingerprint_input(step.explicit_input).encode())
+    return digest.hexdigest()
+
+
+class _CheckpointPickler(pickle.Pickler):
+    """Stores the data behind temp_file_rw handles, which do not outlive the run that created them."""
+
+    def persistent_id(self, obj):
+        if temp_mgr.is_temp_handle(obj):
+            suffix = os.path.splitext(obj)[1]
+            return ("temp_handle", suffix, temp_mgr.read_from_temp_file(obj))
+        return None
+
+
+class _CheckpointUnpickler(pickle.Unpickler):
+    """Re-registers the data of stored handles and substitutes the new handles."""
+
+    def persistent_load(self, pid):
+        kind, suffix, data = pid
+        if kind != "temp_handle":
+            raise pickle.UnpicklingError(f"Unknown persistent id {kind!r}")
+        return temp_mgr.write_to_temp_file(data, suffix=suffix)
+
+
+class CheckpointStore:
+    """
+    Stores step outputs on disk keyed by step name and fingerprint.
+
+    Only the most recent `keep` checkpoints of each step are kept, so switching a step's configuration
+    back and forth reuses earlier results without the store growing without bound.
+    """
+
+    def __init__(self, root, keep=3):
+        self.root = root
+        self.keep = keep
+
+    def exists(self, step_name, fingerprint):
+        return os.path.isfile(self._path(step_name, fingerprint))
+
+    def load(self, step_name, fingerprint):
+        """Returns the stored output of a step."""
+        path = self._path(step_name, fingerprint)
+        with open(path, "rb") as file:
+            data = _CheckpointUnpickler(file).load()
+        os.utime(path)
+        return data
+
+    def save(self, step_name, fingerprint, data):
+        """
+        Stores the output of a step.
+
+        Returns:
+            bool: False if the output cannot be pickled (e.g. a generator of streamed pages), in which
+                case the step is simply not checkpointed.
+        """
+        path = self._path(step_name, fingerprint)
+        try:
+            with atomic_write(path, "wb") as file:
+                _CheckpointPickler(file, protocol=pickle.HIGHEST_PROTOCOL).dump(data)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.info("Step '%s' output cannot be checkpointed: %s", step_name, e)
+            return False
+        self._prune(os.path.dirname(path))
+        return True
+
+    def _prune(self, step_dir):
+        checkpoints = sorted(
+            (os.path.join(step_dir, name) for name in os.listdir(step_dir) if name.endswith(".pkl")),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+        for path in checkpoints[self.keep:]:
+            os.remove(path)
+
+    def _path(self, step_name, fingerprint):
+        return os.path.join(self.root, step_name, fingerprint + ".pkl")
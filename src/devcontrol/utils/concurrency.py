@@ -0,0 +1,31 @@
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+def bounded_map(submit, items, max_pending):
+    """
+    Submits a task per item while keeping at most max_pending of them in flight.
+
+    Items are consumed lazily, so a generator of pages or files is never fully held in memory,
+    and each finished task is handed back before the next item is read once the bound is reached.
+
+    Args:
+        submit (callable): Called with each item; returns a concurrent.futures.Future.
+        items (iterable): Items to submit.
+        max_pending (int): Maximum number of unfinished futures.
+
+    Yields:
+        tuple: (item, future) of each finished task, in completion order. Exceptions stay in the
+            future, for the caller to handle with future.result().
+    """
+    pending = {}
+
+    def finished():
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        return [(pending.pop(future), future) for future in done]
+
+    for item in items:
+        if len(pending) >= max_pending:
+            yield from finished()
+        pending[submit(item)] = item
+    while pending:
+        yield from finished()
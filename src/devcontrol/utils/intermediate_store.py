@@ -0,0 +1,207 @@
+import hashlib
+import json
+import numbers
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.json_enhanced import NumpyEncoder
+from utils import temp_file_rw as temp_mgr
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet support is optional; DataFrames fall back to per-column .npy files
+    pq = None
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+class IntermediateStore:
+    """
+    Stores the intermediate outputs of pipeline steps on disk.
+
+    Each output is written once per step and context under `root/<step_name>/`, together with a small
+    JSON manifest describing how to read it back. Tabular outputs are stored in binary form so they can
+    be memory-mapped instead of re-parsed:
+
+        - pandas DataFrames as Parquet (if pyarrow is installed) or one .npy file per column
+        - numpy arrays and lists of equal-length numeric rows (e.g. box lists) as .npy; lists are
+          read back as lists of rows of the same type, with the int and float columns they had
+        - anything else as JSON
+
+    Handles of the temp object store are replaced by the data they refer to, since the handles do
+    not outlive the run that created them.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def is_manifest(path):
+        """Returns True if path is an existing intermediate manifest file."""
+        return isinstance(path, str) and path.endswith(MANIFEST_SUFFIX) and os.path.isfile(path)
+
+    def write(self, step_name, context, data):
+        """
+        Writes the output of a step for one context.
+
+        Args:
+            step_name (str): Name of the pipeline step.
+            context (str): Item context within the step, e.g. 'step/pages/3' or a relative file path.
+                Each context is stored under a file name of its own.
+            data (any): Output of the step's operation.
+
+        Returns:
+            str: Path to the manifest of the stored output.
+        """
+        step_dir = os.path.join(self.root, _safe_name(step_name))
+        os.makedirs(step_dir, exist_ok=True)
+        base = os.path.join(step_dir, _context_file_name(context))
+        manifest = {"step": step_name, "context": context, "created": time.time()}
+        data = temp_mgr.resolve_temp_handles(data)
+        rows = _rows_array(data)
+
+        if isinstance(data, pd.DataFrame):
+            manifest.update(self._write_frame(base, data))
+        elif isinstance(data, np.ndarray) and data.dtype != object:
+            np.save(base + ".npy", data)
+            manifest.update({"format": "npy", "path": base + ".npy", "container": "ndarray"})
+        elif rows is not None:
+            array, row_type = rows
+            np.save(base + ".npy", array)
+            manifest.update({"format": "npy", "path": base + ".npy", "container": "list", "row_type": row_type})
+        else:
+            with open(base + ".json", "w") as file:
+                json.dump(data, file, cls=NumpyEncoder)
+            manifest.update({"format": "json", "path": base + ".json"})
+
+        manifest_path = base + MANIFEST_SUFFIX
+        with open(manifest_path, "w") as file:
+            json.dump(manifest, file, indent=2)
+        return manifest_path
+
+    def read(self, manifest_path):
+        """
+        Reads a stored output back from its manifest.
+
+        Binary formats are memory-mapped, so large arrays and numeric columns are paged in on access
+        rather than loaded up front. Lists of rows are rebuilt as the lists the step returned.
+        """
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+
+        data_format = manifest["format"]
+        path = manifest["path"]
+        if data_format == "parquet":
+            return pq.read_table(path, memory_map=True).to_pandas()
+        elif data_format == "npy_columns":
+            return self._read_frame_columns(path, manifest)
+        elif data_format == "npy":
+            if manifest.get("container") == "list":
+                # Rows of a structured array come back as tuples of Python ints and floats
+                rows = np.load(path).tolist()
+                if manifest.get("row_type", "tuple") == "list":
+                    return [list(row) for row in rows]
+                return [tuple(row) for row in rows]
+            return np.load(path, mmap_mode="r")
+        elif data_format == "json":
+            with open(path, "r") as file:
+                return json.load(file)
+        raise ValueError(f"Unknown intermediate format '{data_format}' in {manifest_path}")
+
+    def _write_frame(self, base, frame):
+        if pq is not None:
+            path = base + ".parquet"
+            frame.to_parquet(path)
+            return {"format": "parquet", "path": path}
+
+        path = base + "_columns"
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        columns = []
+        for i, name in enumerate(frame.columns):
+            values = frame[name].to_numpy()
+            column = {"name": str(name), "file": f"{i}.npy", "kind": "numeric"}
+            if values.dtype == object:
+                # Strings are stored as a fixed-width array plus a mask of missing values
+                missing = pd.isna(values)
+                np.save(os.path.join(path, f"{i}.mask.npy"), missing)
+                values = np.where(missing, "", values).astype(str)
+                column["kind"] = "string"
+            np.save(os.path.join(path, column["file"]), values)
+            columns.append(column)
+        np.save(os.path.join(path, "index.npy"), frame.index.to_numpy())
+        return {"format": "npy_columns", "path": path, "columns": columns}
+
+    def _read_frame_columns(self, path, manifest):
+        data = {}
+        for column in manifest["columns"]:
+            values = np.load(os.path.join(path, column["file"]), mmap_mode="r")
+            if column["kind"] == "string":
+                missing = np.load(os.path.join(path, column["file"].replace(".npy", ".mask.npy")))
+                values = values.astype(object)
+                values[missing] = None
+            data[column["name"]] = values
+        index = np.load(os.path.join(path, "index.npy"), allow_pickle=True)
+        return pd.DataFrame(data, index=index, copy=False)
+
+
+def _safe_name(name):
+    """Makes a step name or context usable as a file name."""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "__", str(name))
+
+
+def _context_file_name(context):
+    """File name of a context, with a hash of the context if it had to be changed to be one."""
+    name = _safe_name(context)
+    if name != context:
+        name += "-" + hashlib.blake2b(str(context).encode(), digest_size=4).hexdigest()
+    return name
+
+
+def _rows_array(data):
+    """
+    Packs a list of numeric rows into a structured array with one int64 or float64 field per column.
+
+    Returns:
+        tuple: (array, 'list' or 'tuple', the type of the rows), or None if data is not such a
+            list or cannot be stored exactly, e.g. a column mixing ints and floats.
+    """
+    if not _is_numeric_rows(data):
+        return None
+    row_types = {type(row) for row in data}
+    if row_types not in ({list}, {tuple}):
+        return None
+    fields = []
+    for i, column in enumerate(zip(*data)):
+        if all(isinstance(value, numbers.Integral) for value in column):
+            fields.append((f"f{i}", np.int64))
+        elif all(isinstance(value, numbers.Real) and not isinstance(value, numbers.Integral) for value in column):
+            fields.append((f"f{i}", np.float64))
+        else:
+            return None
+    try:
+        array = np.array([tuple(row) for row in data], dtype=fields)
+    except OverflowError:
+        return None
+    return array, row_types.pop().__name__
+
+
+def _is_numeric_rows(data):
+    """True for a non-empty list of equal-length rows of numbers, such as a list of boxes."""
+    if not isinstance(data, list) or not data:
+        return False
+    first = data[0]
+    if not isinstance(first, (list, tuple)) or not first:
+        return False
+    width = len(first)
+    return all(
+        isinstance(row, (list, tuple)) and len(row) == width
+        and all(isinstance(value, numbers.Number) and not isinstance(value, bool) for value in row)
+        for row in data
+    )
@@ -1,6 +1,9 @@
 import importlib
 import os
 import json
+import sys
+import tempfile
+from contextlib import contextmanager
 
 def load_function(name, function_name, pkg='operations'):
     """Dynamically loads a function from a module."""
@@ -8,6 +11,22 @@ def load_function(name, function_name, pkg='operations'):
     module = importlib.import_module(module_name)
     return getattr(module, function_name)
 
+def estimate_size(data):
+    """Rough size in bytes of an object held in memory."""
+    if hasattr(data, "memory_usage"):  # pandas DataFrame or Series
+        usage = data.memory_usage(deep=True)
+        return int(usage.sum() if hasattr(usage, "sum") else usage)
+    if hasattr(data, "nbytes"):  # numpy array
+        return data.nbytes
+    if hasattr(data, "getbands") and hasattr(data, "size"):  # PIL image
+        width, height = data.size
+        return width * height * len(data.getbands())
+    if isinstance(data, dict):
+        return sys.getsizeof(data) + sum(estimate_size(key) + estimate_size(value) for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return sys.getsizeof(data) + sum(estimate_size(item) for item in data)
+    return sys.getsizeof(data)
+
 def read_json(file_path):
     """Reads JSON data from a file."""
     with open(file_path, 'r') as file:
@@ -19,6 +38,26 @@ def write_json(data, file_path):
     with open(file_path, 'w') as file:
         json.dump(data, file, indent=4)
 
+@contextmanager
+def atomic_write(file_path, mode="w"):
+    """
+    Opens a temporary file next to file_path and renames it onto file_path when the block ends.
+
+    Readers, including other processes, see either the old file or the complete new one, never a
+    partial write. If the block raises, the temporary file is removed and file_path is left as it was.
+    """
+    directory = os.path.dirname(file_path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 
 def run_printer():
     inputfile = "/tmp/tmp1zi46ztv.json"
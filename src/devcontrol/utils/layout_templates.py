@@ -0,0 +1,314 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from utils.io_utils import atomic_write
+
+logger = logging.getLogger("application")
+
+# Pixels darker than this are ink, as in lines_and_text.preprocess_image
+INK_THRESHOLD = 200
+
+# Rows (columns) with line pixels across at least this fraction of the page width (height) are
+# rules; those with at least SEGMENT_FRACTION hold shorter line segments, e.g. the dividers of a row
+RULE_FRACTION = 0.3
+SEGMENT_FRACTION = 0.01
+
+# Signatures are computed on the page downscaled to this height, with line segments shorter than
+# SIGNATURE_KERNEL pixels there (text, mostly) removed
+SIGNATURE_HEIGHT = 800
+SIGNATURE_KERNEL = 15
+
+# The journal is rewritten without duplicate or unreadable lines once it holds this many more
+# lines than templates
+COMPACT_SLACK = 100
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+class LayoutRegistry:
+    """
+    Registry of known page layouts and their boxes, stored as a JSON lines journal.
+
+    New layouts are appended to the journal, one line each, under an exclusive lock on
+    '<path>.lock', so the batch workers of several processes can share a registry without losing
+    each other's layouts. Every lookup first reads whatever other processes appended since.
+
+    A layout is recognized by its signature: where the page's horizontal lines lie along the vertical
+    axis and its vertical lines along the horizontal axis, relative to the outermost rules, as a
+    histogram of a fixed number of bins weighted by the length of the lines. The lines are found on a
+    downscaled copy of the page, so the signature costs a small fraction of line detection. Measuring
+    positions from the outermost rules makes the signature independent of where the form sits on the
+    page and of the rendering resolution, so a match gives a per-axis scale and offset that map the
+    stored boxes onto the new page. Profiles of the same layout correlate above 0.85 even with
+    shifted or rescaled scans and different layouts stay below 0.3, so min_score only prunes the
+    candidates and the rules decide. A match is only accepted if the stored rules, mapped the same
+    way, fall on the rules of the new page: at least min_rule_fraction of them within
+    rule_tolerance (a fraction of the distance between the outermost rules).
+    """
+
+    def __init__(self, path, bins=128, min_score=0.6, rule_tolerance=0.004, min_rule_fraction=0.9):
+        self.path = path
+        self.bins = bins
+        self.min_score = min_score
+        self.rule_tolerance = rule_tolerance
+        self.min_rule_fraction = min_rule_fraction
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._lines = 0
+        self._offset = 0
+        self._inode = None
+        self._refresh()
+
+    def signature(self, gray):
+        """
+        Computes the layout signature of a grayscale page.
+
+        Returns:
+            dict: y_profile and x_profile (lists of bins floats), y_rules and x_rules (positions of the
+                rules of each axis), y_extent and x_extent (first and last rule of each axis), in pixels
+                of the page, or None if the page has fewer than two rules on an axis.
+        """
+        factor = min(1.0, SIGNATURE_HEIGHT / gray.shape[0])
+        small = cv2.resize(gray, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+        _, ink = cv2.threshold(small, INK_THRESHOLD - 1, 1, cv2.THRESH_BINARY_INV)
+        horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (SIGNATURE_KERNEL, 1))
+        vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, SIGNATURE_KERNEL))
+        horizontal = cv2.morphologyEx(ink, cv2.MORPH_OPEN, horizontal_kernel)
+        vertical = cv2.morphologyEx(ink, cv2.MORPH_OPEN, vertical_kernel)
+
+        y_profile = horizontal.mean(axis=1)
+        x_profile = vertical.mean(axis=0)
+        y_rules, _ = _runs(y_profile, RULE_FRACTION)
+        x_rules, _ = _runs(x_profile, RULE_FRACTION)
+        if len(y_rules) < 2 or len(x_rules) < 2:
+            return None
+        y0, y1 = y_rules[0], y_rules[-1]
+        x0, x1 = x_rules[0], x_rules[-1]
+
+        def to_page(positions):
+            # Center of the downscaled pixel, in page pixels
+            return [round((float(position) + 0.5) / factor - 0.5, 1) for position in positions]
+
+        return {
+            "y_profile": _histogram(*_runs(y_profile, SEGMENT_FRACTION), y0, y1, self.bins),
+            "x_profile": _histogram(*_runs(x_profile, SEGMENT_FRACTION), x0, x1, self.bins),
+            "y_rules": to_page(y_rules),
+            "x_rules": to_page(x_rules),
+            "y_extent": to_page([y0, y1]),
+            "x_extent": to_page([x0, x1]),
+        }
+
+    def match(self, gray, signature=None):
+        """
+        Looks up the layout of a page.
+
+        Args:
+            gray (numpy.ndarray): Grayscale page.
+            signature (dict): The page's signature, if already computed.
+
+        Returns:
+            list: (top, left, bottom, right) of each box of the matching layout mapped onto the page,
+                or None if no stored layout matches.
+        """
+        signature = signature or self.signature(gray)
+        if signature is None:
+            return None
+
+        with self._lock:
+            self._refresh()
+            templates = list(self._templates.values())
+        candidates = sorted(((_score(signature, template), template) for template in templates),
+                            key=lambda candidate: candidate[0], reverse=True)
+        for score, template in candidates:
+            if score < self.min_score:
+                break
+            if self._rules_agree(template, signature):
+                with self._lock:
+                    self.hits += 1
+                return _align(template, signature, gray.shape)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def add(self, gray, boxes, signature=None):
+        """
+        Stores the boxes detected on a page as the template of its layout.
+
+        Returns:
+            bool: False if the page has no usable signature or no boxes.
+        """
+        signature = signature or self.signature(gray)
+        if signature is None or not boxes:
+            return False
+        template = dict(signature, boxes=[[int(value) for value in box] for box in boxes])
+        template_id = hashlib.blake2b(json.dumps(template, sort_keys=True).encode(), digest_size=10).hexdigest()
+
+        line = json.dumps(dict(template, id=template_id)) + "\n"
+        with self._lock, _FileLock(self.path + ".lock"):
+            self._refresh()
+            if template_id not in self._templates:
+                with open(self.path, "a") as f:
+                    f.write(line)
+                self._refresh()
+            if self._lines > len(self._templates) + COMPACT_SLACK:
+                self._compact()
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"templates": len(self._templates), "hits": self.hits, "misses": self.misses}
+
+    def _refresh(self):
+        """Reads the layouts appended to the journal since it was last read. Call with _lock held."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            # Compacted by another process: read it again from the start
+            self._templates, self._lines, self._offset, self._inode = {}, 0, 0, stat.st_ino
+        if stat.st_size == self._offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        # A line still being written by another process is read next time
+        complete = data.rfind(b"\n") + 1
+        for line in data[:complete].splitlines():
+            self._lines += 1
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.error("Skipping an unreadable line of layout registry %s", self.path)
+                continue
+            self._templates[record.pop("id")] = record
+        self._offset += complete
+
+    def _compact(self):
+        """Rewrites the journal with one line per layout. Call with _lock and the file lock held."""
+        with atomic_write(self.path) as f:
+            for template_id, template in self._templates.items():
+                f.write(json.dumps(dict(template, id=template_id)) + "\n")
+        stat = os.stat(self.path)
+        self._lines, self._offset, self._inode = len(self._templates), stat.st_size, stat.st_ino
+
+    def _rules_agree(self, template, signature):
+        """True if nearly all rules of the template and the page coincide once the template is mapped onto the page."""
+        for axis in ("y", "x"):
+            (t0, t1), (p0, p1) = template[f"{axis}_extent"], signature[f"{axis}_extent"]
+            tolerance = self.rule_tolerance * (p1 - p0)
+            mapped = p0 + (np.asarray(template[f"{axis}_rules"], dtype=float) - t0) * (p1 - p0) / (t1 - t0)
+            rules = np.asarray(signature[f"{axis}_rules"], dtype=float)
+            if min(len(mapped), len(rules)) < self.min_rule_fraction * max(len(mapped), len(rules)):
+                return False
+            # Distance from each mapped rule to the nearest rule of the page
+            index = np.clip(np.searchsorted(rules, mapped), 1, len(rules) - 1)
+            distance = np.minimum(np.abs(rules[index - 1] - mapped), np.abs(rules[index] - mapped))
+            if np.mean(distance <= tolerance) < self.min_rule_fraction:
+                return False
+        return True
+
+
+def _runs(profile, threshold):
+    """Centers and peak values of the runs of rows (columns) of a projection at or above threshold."""
+    above = np.concatenate([[False], profile >= threshold, [False]])
+    changes = np.flatnonzero(above[1:] != above[:-1])
+    starts, stops = changes[0::2], changes[1::2]
+    if len(starts) == 0:
+        return np.empty(0), np.empty(0)
+    # Rows between runs are below threshold, so the maximum from one start to the next is the run's peak
+    peaks = np.maximum.reduceat(profile, starts)
+    return (starts + stops - 1) / 2, peaks
+
+
+def _histogram(centers, weights, start, stop, bins):
+    """
+    Histogram of the positions of runs between start and stop, blurred by about a bin so a run that
+    falls on either side of a bin edge gives nearly the same signature.
+    """
+    index = np.clip(((centers - start) / (stop - start) * bins).astype(int), -1, bins)
+    inside = (index >= 0) & (index < bins)
+    histogram = np.bincount(index[inside], weights=weights[inside], minlength=bins)
+    blurred = np.convolve(histogram, [1 / 16, 4 / 16, 6 / 16, 4 / 16, 1 / 16], mode='same')
+    return np.round(blurred, 4).tolist()
+
+
+def _score(signature, template):
+    """Lower of the correlations of the two axes' profiles."""
+    scores = []
+    for key in ("y_profile", "x_profile"):
+        a = np.asarray(signature[key])
+        b = np.asarray(template[key])
+        if len(a) != len(b) or a.std() == 0 or b.std() == 0:
+            return -1.0
+        scores.append(float(np.corrcoef(a, b)[0, 1]))
+    return min(scores)
+
+
+def _align(template, signature, shape):
+    """Maps the template's boxes onto a page with a scale and offset per axis."""
+    (ty0, ty1), (tx0, tx1) = template["y_extent"], template["x_extent"]
+    (py0, py1), (px0, px1) = signature["y_extent"], signature["x_extent"]
+    y_scale = (py1 - py0) / (ty1 - ty0)
+    x_scale = (px1 - px0) / (tx1 - tx0)
+
+    boxes = np.asarray(template["boxes"], dtype=float).reshape(-1, 4)
+    tops = np.clip(np.round(py0 + (boxes[:, 0] - ty0) * y_scale), 0, shape[0] - 1)
+    lefts = np.clip(np.round(px0 + (boxes[:, 1] - tx0) * x_scale), 0, shape[1] - 1)
+    bottoms = np.clip(np.round(py0 + (boxes[:, 2] - ty0) * y_scale), 0, shape[0] - 1)
+    rights = np.clip(np.round(px0 + (boxes[:, 3] - tx0) * x_scale), 0, shape[1] - 1)
+    return [(int(t), int(l), int(b), int(r)) for t, l, b, r in
+            zip(tops.tolist(), lefts.tolist(), bottoms.tolist(), rights.tolist())]
+
+
+class _FileLock:
+    """Exclusive advisory lock on a file, held across processes for the duration of a with block."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "a")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def get_layout_registry(path):
+    """
+    Returns the shared layout registry stored at path, loading it on first use.
+
+    Args:
+        path (str): JSON lines journal holding the registry. If None, layout matching is disabled.
+
+    Returns:
+        LayoutRegistry: The registry, or None if path is None.
+    """
+    if path is None:
+        return None
+    with _registries_lock:
+        registry = _registries.get(path)
+        if registry is None:
+            registry = LayoutRegistry(path)
+            _registries[path] = registry
+        return registry
@@ -1,25 +1,138 @@
 #!/usr/bin/env python3
-import shlex
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
-import subprocess
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-def setup_logger(name, log_file, level=logging.INFO):
-    """Sets up a logger with a specified name and log file."""
-    handler = logging.handlers.RotatingFileHandler(log_file, mode='w',  maxBytes=1024*1024,    # 1MB per file
-            backupCount=3)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
+# Logger name -> (QueueListeners writing its records, handler queueing them)
+_listeners = {}
+_setup_lock = threading.Lock()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Samples repetitive messages.
+
+    Records below WARNING are counted per message template (the unformatted msg), and at most `rate`
+    of each template pass per `period` seconds. The next record that passes reports how many were
+    dropped. Warnings and errors always pass.
+    """
+
+    def __init__(self, rate=20, period=1.0):
+        super().__init__()
+        self.rate = rate
+        self.period = period
+        self._windows = {}  # msg -> [window start, passed, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(record.msg)
+            if window is None or now - window[0] >= self.period:
+                suppressed = window[2] if window is not None else 0
+                self._windows[record.msg] = [now, 1, 0]
+            elif window[1] < self.rate:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+class _ProcessAwareQueueHandler(QueueHandler):
+    """
+    Queues records for the listener threads of the process that set up logging.
+
+    Forked worker processes inherit the handler but not the listener threads, so they send their
+    records to the parent through a multiprocessing queue instead; only the parent's listeners
+    ever write to and rotate the log file.
+    """
+
+    def __init__(self, log_queue, child_queue):
+        super().__init__(log_queue)
+        self.child_queue = child_queue
+        self._pid = os.getpid()
+
+    def enqueue(self, record):
+        if os.getpid() == self._pid:
+            self.queue.put_nowait(record)
+        else:
+            self.child_queue.put_nowait(record)
+
+
+def setup_logger(name, log_file, level=logging.INFO, rate=20):
+    """
+    Sets up a logger with a specified name and log file.
+
+    Records are put on a queue and written to the (rotating) log file by a background thread, so
+    logging does not block the caller on file I/O. Calling this again for the same name only
+    updates the level; the handlers are installed once.
+
+    Args:
+        name (str): Logger name.
+        log_file (str): Path of the log file.
+        level (int): Logging level.
+        rate (int): Maximum number of records per message template and second below WARNING,
+            see RateLimitFilter. None disables sampling.
+
+    Returns:
+        logging.Logger: The configured logger.
+    """
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    logger.addHandler(handler)
-    return logger
+    with _setup_lock:
+        if name in _listeners:
+            return logger
 
-# Example usage in other modules:
-# logger = setup_logger("application", "logs/application.log")
+        file_handler = RotatingFileHandler(log_file, mode='w', maxBytes=1024*1024,  # 1MB per file
+                                           backupCount=3)
+        file_handler.setFormatter(logging.Formatter(FORMAT))
 
+        # The parent's own records skip the pickling a multiprocessing queue needs
+        log_queue = queue.SimpleQueue()
+        child_queue = multiprocessing.Queue()
+        listeners = [QueueListener(log_queue, file_handler, respect_handler_level=True),
+                     QueueListener(child_queue, file_handler, respect_handler_level=True)]
+        queue_handler = _ProcessAwareQueueHandler(log_queue, child_queue)
+        if rate is not None:
+            # Filtered on the caller's side so dropped records are never formatted or queued
+            queue_handler.addFilter(RateLimitFilter(rate=rate))
+        logger.addHandler(queue_handler)
 
+        for listener in listeners:
+            listener.start()
+        _listeners[name] = (listeners, queue_handler)
+    return logger
+
+
+def stop_logging():
+    """Writes all queued records, stops the listener threads and removes the handlers."""
+    with _setup_lock:
+        for name, (listeners, queue_handler) in _listeners.items():
+            if queue_handler._pid != os.getpid():
+                continue  # A forked child: the listeners belong to the parent
+            logging.getLogger(name).removeHandler(queue_handler)
+            for listener in listeners:
+                listener.stop()
+            queue_handler.child_queue.close()
+            queue_handler.child_queue.join_thread()
+            listeners[0].handlers[0].close()
+        _listeners.clear()
 
 
+atexit.register(stop_logging)
 
+# Example usage in other modules:
+# logger = setup_logger("application", "logs/application.log")
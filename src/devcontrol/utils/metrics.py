@@ -0,0 +1,239 @@
+import cProfile
+import json
+import os
+import re
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from utils.io_utils import atomic_write, estimate_size
+
+
+class StepMetrics:
+    """Measurements of one pipeline step."""
+
+    def __init__(self, step_name):
+        self.step_name = step_name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.items = 0
+        self.failures = 0
+        self.item_seconds = 0.0
+        self.max_item_seconds = 0.0
+        self.input_bytes = None
+        self.output_bytes = None
+        self.peak_rss_bytes = None
+        self.loaded_from_checkpoint = False
+
+    def merge(self, other):
+        """Adds the item measurements of other, e.g. taken in a worker process."""
+        self.items += other.items
+        self.failures += other.failures
+        self.item_seconds += other.item_seconds
+        self.max_item_seconds = max(self.max_item_seconds, other.max_item_seconds)
+
+    def to_dict(self):
+        return {
+            "step": self.step_name,
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "items": self.items,
+            "failures": self.failures,
+            "mean_item_seconds": self.item_seconds / self.items if self.items else 0.0,
+            "max_item_seconds": self.max_item_seconds,
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "loaded_from_checkpoint": self.loaded_from_checkpoint,
+        }
+
+
+class PipelineMetrics:
+    """
+    Collects per-step metrics of a pipeline run and exports them.
+
+    Steps are measured with step(), items with record_item(). A step can additionally be run under
+    cProfile and/or tracemalloc; the results are written next to the run report.
+
+    The peak RSS of a step is the pipeline process' high-water mark during the step, which is reset
+    at the start of the step through /proc/self/clear_refs. Where that is unavailable (not Linux, or
+    not permitted) it is not recorded; the run report always has the process-lifetime peak.
+    Estimating the size of every step's input and output walks the data, so it is only done with
+    measure_sizes.
+    """
+
+    def __init__(self, report_dir=None, measure_sizes=False):
+        self.report_dir = report_dir
+        self.measure_sizes = measure_sizes
+        self.steps = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks cannot be pickled; process-mode workers get a copy of the manager
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, step_name):
+        with self._lock:
+            metrics = self.steps.get(step_name)
+            if metrics is None:
+                metrics = StepMetrics(step_name)
+                self.steps[step_name] = metrics
+            return metrics
+
+    @contextmanager
+    def step(self, step_name, input_data, profile=()):
+        """
+        Measures wall time, CPU time, peak RSS and, with measure_sizes, input size of a step.
+
+        Args:
+            step_name (str): Name of the step.
+            input_data (any): Input of the step, for its size.
+            profile (iterable): "cprofile" and/or "tracemalloc" to capture a profile of the step.
+
+        Yields:
+            StepMetrics: The step's metrics; set output_bytes through record_output().
+        """
+        metrics = self.get(step_name)
+        if self.measure_sizes:
+            metrics.input_bytes = estimate_size(input_data)
+        peak_reset = _reset_peak_rss()
+
+        profiler = cProfile.Profile() if "cprofile" in profile else None
+        tracing = "tracemalloc" in profile and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start(25)
+        if profiler is not None:
+            profiler.enable()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield metrics
+        finally:
+            metrics.wall_seconds += time.perf_counter() - wall_start
+            metrics.cpu_seconds += time.process_time() - cpu_start
+            if peak_reset:
+                metrics.peak_rss_bytes = max(metrics.peak_rss_bytes or 0, _step_peak_rss_bytes())
+            if profiler is not None:
+                profiler.disable()
+                self._write_profile(step_name, profiler)
+            if tracing:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                self._write_tracemalloc(step_name, snapshot)
+
+    def record_output(self, step_name, output_data):
+        if self.measure_sizes:
+            self.get(step_name).output_bytes = estimate_size(output_data)
+
+    def record_item(self, step_name, seconds, failed=False):
+        metrics = self.get(step_name)
+        with self._lock:
+            metrics.items += 1
+            metrics.failures += int(failed)
+            metrics.item_seconds += seconds
+            metrics.max_item_seconds = max(metrics.max_item_seconds, seconds)
+
+    def merge(self, other):
+        """Adds the item measurements collected by another PipelineMetrics, e.g. in a worker process."""
+        for step_name, metrics in other.steps.items():
+            target = self.get(step_name)
+            with self._lock:
+                target.merge(metrics)
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "wall_seconds": time.time() - self.started,
+            # Resetting the high-water mark for each step also resets ru_maxrss, so the steps'
+            # peaks are taken into account
+            "process_peak_rss_bytes": max([_peak_rss_bytes()] + [metrics.peak_rss_bytes or 0
+                                                                 for metrics in self.steps.values()]),
+            "steps": [metrics.to_dict() for metrics in self.steps.values()],
+        }
+
+    def write_report(self, path):
+        """Writes the run report as JSON."""
+        _write_atomic(path, json.dumps(self.to_dict(), indent=2))
+
+    def write_prometheus(self, path, prefix="devcontrol_pipeline"):
+        """Writes the step metrics in the Prometheus text format, e.g. for the node exporter textfile collector."""
+        series = [
+            ("wall_seconds", "Wall time of the step in seconds."),
+            ("cpu_seconds", "CPU time of the pipeline process during the step in seconds."),
+            ("items", "Number of items the step's operation ran on."),
+            ("failures", "Number of items that failed."),
+            ("max_item_seconds", "Longest time spent on one item in seconds."),
+            ("input_bytes", "Estimated size of the step's input in bytes."),
+            ("output_bytes", "Estimated size of the step's output in bytes."),
+            ("peak_rss_bytes", "Peak resident set size of the pipeline process during the step."),
+        ]
+        steps = [metrics.to_dict() for metrics in self.steps.values()]
+        lines = []
+        for key, description in series:
+            name = f"{prefix}_step_{key}"
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            for metrics in steps:
+                if metrics[key] is None:  # Not measured
+                    continue
+                lines.append(f'{name}{{step="{_label_value(metrics["step"])}"}} {metrics[key]}')
+        lines.append(f"# HELP {prefix}_last_run_timestamp_seconds Start time of the last run.")
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{prefix}_last_run_timestamp_seconds {self.started}")
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+    def _write_profile(self, step_name, profiler):
+        if self.report_dir is None:
+            return
+        os.makedirs(self.report_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(self.report_dir, f"{step_name}.prof"))
+
+    def _write_tracemalloc(self, step_name, snapshot, limit=25):
+        if self.report_dir is None:
+            return
+        lines = [str(stat) for stat in snapshot.statistics("lineno")[:limit]]
+        _write_atomic(os.path.join(self.report_dir, f"{step_name}_tracemalloc.txt"), "\n".join(lines) + "\n")
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux; worker processes are counted through RUSAGE_CHILDREN
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * 1024
+
+
+def _reset_peak_rss():
+    """Resets the process' peak RSS (VmHWM) to its current RSS. Returns False if not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _step_peak_rss_bytes():
+    """Peak RSS of the process since the last _reset_peak_rss()."""
+    with open("/proc/self/status") as file:
+        match = re.search(r"^VmHWM:\s+(\d+) kB", file.read(), re.MULTILINE)
+    return int(match.group(1)) * 1024 if match else 0
+
+
+def _label_value(value):
+    """Escapes a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomic(path, text):
+    with atomic_write(path) as file:
+        file.write(text)
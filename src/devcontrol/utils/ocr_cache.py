@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+
+import numpy as np
+
+from utils.io_utils import atomic_write
+
+logger = logging.getLogger("application")
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class OcrCache:
+    """
+    Content-addressed on-disk cache of OCR results.
+
+    Entries are keyed by a hash of the image pixels plus the Tesseract call and config string, so a
+    rerun on unchanged pages or regions never reaches Tesseract. The cache is bounded by total size
+    on disk; when it grows past `max_bytes` the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(os.path.getsize(path) for path in self._entry_paths())
+
+    @staticmethod
+    def key(image, config="", kind="image_to_data"):
+        """
+        Computes the cache key for an image and a Tesseract call.
+
+        Args:
+            image (PIL.Image.Image or numpy.ndarray): Page or region of interest.
+            config (str): Tesseract config string, e.g. '--oem 3 --psm 6'.
+            kind (str): Name of the Tesseract call, so text and data results do not collide.
+
+        Returns:
+            str: Hex digest identifying the image content and OCR settings.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        if isinstance(image, np.ndarray):
+            image = np.ascontiguousarray(image)
+            digest.update(f"{image.shape}|{image.dtype}".encode())
+        else:
+            digest.update(f"{image.size}|{image.mode}".encode())
+        digest.update(f"|{kind}|{config}|".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns the cached value for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Refresh the access time used for LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Stores value under key, evicting least recently used entries if the cache is over budget."""
+        path = self._path(key)
+        # An overwritten entry no longer takes its old size on disk
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+
+        # Written atomically so concurrent readers never see a partial entry
+        with atomic_write(path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            size = os.fstat(f.fileno()).st_size - old_size
+
+        with self._lock:
+            self._total_bytes += size
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self, target_fraction=0.9):
+        """Removes least recently used entries until the cache is below target_fraction of max_bytes."""
+        entries = []
+        for path in self._entry_paths():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * target_fraction
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+
+        with self._lock:
+            self._total_bytes = total
+        logger.info("OCR cache %s: evicted %s entries, %s bytes remain.", self.cache_dir, removed, total)
+
+    def stats(self):
+        """Returns hit/miss counters and the current size of the cache."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".pkl")
+
+    def _entry_paths(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for filename in files:
+                if filename.endswith(".pkl"):
+                    yield os.path.join(root, filename)
+
+
+def get_ocr_cache(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Returns the shared cache for cache_dir, creating it on first use.
+
+    Args:
+        cache_dir (str): Directory holding the cache. If None, caching is disabled.
+        max_bytes (int): Size limit of the cache on disk.
+
+    Returns:
+        OcrCache: The cache, or None if cache_dir is None.
+    """
+    if cache_dir is None:
+        return None
+    with _caches_lock:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            cache = OcrCache(cache_dir, max_bytes=max_bytes)
+            _caches[cache_dir] = cache
+        return cache
@@ -0,0 +1,208 @@
+import csv
+import io
+import logging
+import os
+import queue
+import shlex
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+try:
+    import tesserocr
+except ImportError:  # The tesserocr binding is optional; pytesseract is used if it is missing
+    tesserocr = None
+
+import pytesseract
+
+logger = logging.getLogger("application")
+
+TSV_COLUMNS = ["level", "page_num", "block_num", "par_num", "line_num", "word_num",
+               "left", "top", "width", "height", "conf", "text"]
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def parse_config(config):
+    """
+    Splits a Tesseract command line config such as '--oem 3 --psm 6 -c key=value'.
+
+    Returns:
+        tuple: (oem or None, psm or None, dict of -c variables)
+    """
+    oem = psm = None
+    variables = {}
+    args = shlex.split(config or "")
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "--oem" and i + 1 < len(args):
+            oem = int(args[i + 1])
+            i += 1
+        elif arg == "--psm" and i + 1 < len(args):
+            psm = int(args[i + 1])
+            i += 1
+        elif arg == "-c" and i + 1 < len(args):
+            key, _, value = args[i + 1].partition("=")
+            variables[key] = value
+            i += 1
+        i += 1
+    return oem, psm, variables
+
+
+class TesserocrEngine:
+    """A long-lived Tesseract instance using the tesserocr C-API binding; language data is loaded once."""
+
+    def __init__(self, lang="eng"):
+        self.lang = lang
+        self._apis = {}  # One initialized API per OCR engine mode
+        self._defaults = {}  # OCR engine mode -> {variable: value before the first call set it}
+
+    def _api(self, config):
+        oem, psm, variables = parse_config(config)
+        oem = tesserocr.OEM.DEFAULT if oem is None else oem
+        api = self._apis.get(oem)
+        if api is None:
+            api = tesserocr.PyTessBaseAPI(lang=self.lang, oem=oem)
+            self._apis[oem] = api
+            self._defaults[oem] = {}
+        api.SetPageSegMode(tesserocr.PSM.AUTO if psm is None else psm)
+
+        # Variables stay set on the API, so those set by an earlier call but not by this one
+        # are restored to their defaults
+        defaults = self._defaults[oem]
+        for key, value in defaults.items():
+            if key not in variables:
+                api.SetVariable(key, value)
+        for key, value in variables.items():
+            if key not in defaults:
+                defaults[key] = api.GetVariableAsString(key) or ""
+            api.SetVariable(key, value)
+        return api
+
+    def image_to_string(self, image, config=""):
+        api = self._api(config)
+        api.SetImage(image)
+        return api.GetUTF8Text()
+
+    def image_to_data(self, image, config=""):
+        api = self._api(config)
+        api.SetImage(image)
+        tsv = api.GetTSVText(0)
+        return pd.read_csv(io.StringIO(tsv), sep="\t", names=TSV_COLUMNS, header=None, quoting=csv.QUOTE_NONE)
+
+    def close(self):
+        for api in self._apis.values():
+            api.End()
+        self._apis = {}
+        self._defaults = {}
+
+
+class PytesseractEngine:
+    """Fallback engine that runs the tesseract executable through pytesseract for every call."""
+
+    def image_to_string(self, image, config=""):
+        return pytesseract.image_to_string(image, config=config)
+
+    def image_to_data(self, image, config=""):
+        return pytesseract.image_to_data(image, config=config, output_type=pytesseract.Output.DATAFRAME)
+
+    def close(self):
+        pass
+
+
+class OcrEnginePool:
+    """
+    A pool of warm OCR engines shared by the threads of a process.
+
+    Engines are created on demand up to `size` and reused afterwards, so the language data is
+    loaded once per engine rather than once per call. Per-call latency is recorded for each kind
+    of call and reported by stats().
+    """
+
+    def __init__(self, size=None, lang="eng"):
+        self.size = size or os.cpu_count() or 1
+        self.lang = lang
+        self.backend = "tesserocr" if tesserocr is not None else "pytesseract"
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._latency = {}
+
+    def image_to_string(self, image, config=""):
+        """Returns the text of an image, as pytesseract.image_to_string does."""
+        return self._call("image_to_string", image, config)
+
+    def image_to_data(self, image, config=""):
+        """Returns words and their boxes as a DataFrame, as pytesseract.image_to_data(output_type=DATAFRAME) does."""
+        return self._call("image_to_data", image, config)
+
+    def stats(self):
+        """Returns the call count and latency in milliseconds of each kind of call."""
+        with self._lock:
+            return {
+                kind: {
+                    "calls": calls,
+                    "mean_ms": 1000 * total / calls,
+                    "max_ms": 1000 * longest,
+                }
+                for kind, (calls, total, longest) in self._latency.items()
+            } | {"backend": self.backend, "engines": self._created}
+
+    def close(self):
+        """Releases the engines that are not in use."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _call(self, kind, image, config):
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        engine = self._acquire()
+        start = time.perf_counter()
+        try:
+            return getattr(engine, kind)(image, config=config)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._idle.put(engine)
+            with self._lock:
+                calls, total, longest = self._latency.get(kind, (0, 0.0, 0.0))
+                self._latency[kind] = (calls + 1, total + elapsed, max(longest, elapsed))
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            if tesserocr is not None:
+                return TesserocrEngine(lang=self.lang)
+            return PytesseractEngine()
+        return self._idle.get()
+
+
+def get_engine_pool(size=None):
+    """
+    Returns the OCR engine pool of the current process, creating it on first use.
+
+    Worker processes started by a process pool get a pool of their own rather than a copy of
+    their parent's engines.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = OcrEnginePool(size=size)
+            _pool_pid = os.getpid()
+            logger.info("Created OCR engine pool with up to %s %s engines.", _pool.size, _pool.backend)
+        return _pool
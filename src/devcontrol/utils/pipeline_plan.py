@@ -0,0 +1,124 @@
+from exceptions.app_exceptions import ConfigurationError
+from utils.io_utils import load_function
+
+PARALLEL_MODES = ("thread", "process")
+PROFILERS = ("cprofile", "tracemalloc")
+
+
+class PipelineStep:
+    """
+    A pipeline step compiled from its configuration.
+
+    The operation is resolved and the options are validated once when the pipeline is loaded, so
+    running the step on an item is just a call to `operation`.
+    """
+
+    def __init__(self, step_config, operation):
+        self.config = step_config
+        self.name = step_config["step_name"]
+        self.module = step_config["module"]
+        self.function = step_config["function"]
+        self.operation = operation
+        self.options = step_config.get("options", {})
+        self.skip_step = step_config.get("skip_step", False)
+        self.skip_sequencing = step_config.get("skip_sequencing", False)
+        self.explicit_input = step_config.get("explicit_input", None)
+        self.parallel = step_config.get("parallel", None)
+        self.checkpoint = step_config.get("checkpoint", True)
+        self.directory = step_config.get("directory", None)
+        self.profile = _profilers(step_config.get("profile", ()))
+
+        # Output policy
+        self.use_intermediate_file = step_config.get("use_intermediate_file", False)
+
+    def __repr__(self):
+        return f"PipelineStep({self.name!r}, {self.module}.{self.function})"
+
+
+def compile_step(step_config, pkg='operations'):
+    """
+    Validates a step configuration and resolves its operation.
+
+    Args:
+        step_config (dict): One entry of the "pipeline" list.
+        pkg (str): Package the step's module is imported from.
+
+    Returns:
+        PipelineStep: The compiled step.
+
+    Raises:
+        ConfigurationError: If the step is missing required keys, has invalid options or names a
+            module or function that cannot be loaded.
+    """
+    missing = [key for key in ("step_name", "module", "function") if key not in step_config]
+    if missing:
+        raise ConfigurationError(f"Pipeline step {step_config} is missing required keys: {', '.join(missing)}")
+    step_name = step_config["step_name"]
+
+    options = step_config.get("options", {})
+    if not isinstance(options, dict):
+        raise ConfigurationError(f"Step '{step_name}': 'options' must be an object, got {type(options).__name__}.")
+
+    parallel = step_config.get("parallel")
+    if parallel is not None:
+        if not isinstance(parallel, dict):
+            raise ConfigurationError(f"Step '{step_name}': 'parallel' must be an object.")
+        mode = parallel.get("mode", "thread")
+        if mode not in PARALLEL_MODES:
+            raise ConfigurationError(f"Step '{step_name}': unknown parallel mode '{mode}'.")
+        workers = parallel.get("workers")
+        if workers is not None and (not isinstance(workers, int) or workers < 1):
+            raise ConfigurationError(f"Step '{step_name}': parallel workers must be a positive integer.")
+
+    directory = step_config.get("directory")
+    if directory is not None:
+        if not isinstance(directory, dict):
+            raise ConfigurationError(f"Step '{step_name}': 'directory' must be an object.")
+        workers = directory.get("workers", 4)
+        if not isinstance(workers, int) or workers < 1:
+            raise ConfigurationError(f"Step '{step_name}': directory workers must be a positive integer.")
+
+    unknown = [name for name in _profilers(step_config.get("profile", ())) if name not in PROFILERS]
+    if unknown:
+        raise ConfigurationError(f"Step '{step_name}': unknown profiler(s) {', '.join(unknown)}; "
+                                 f"use {' or '.join(PROFILERS)}.")
+
+    # Skipped steps pass their input through, so their operation is never needed
+    operation = None
+    if not step_config.get("skip_step", False):
+        try:
+            operation = load_function(step_config["module"], step_config["function"], pkg=pkg)
+        except (ImportError, AttributeError) as e:
+            raise ConfigurationError(
+                f"Step '{step_name}': cannot load {step_config['module']}.{step_config['function']}: {e}") from e
+
+    return PipelineStep(step_config, operation)
+
+
+def compile_pipeline(pipeline_config, pkg='operations'):
+    """
+    Compiles every step of the pipeline configuration.
+
+    Args:
+        pipeline_config (list): The "pipeline" list of the configuration file.
+        pkg (str): Package the step modules are imported from.
+
+    Returns:
+        list: PipelineStep objects in pipeline order.
+    """
+    if not isinstance(pipeline_config, list):
+        raise ConfigurationError("The 'pipeline' configuration must be a list of steps.")
+    steps = [compile_step(step_config, pkg=pkg) for step_config in pipeline_config]
+
+    names = [step.name for step in steps]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ConfigurationError(f"Duplicate pipeline step names: {', '.join(duplicates)}")
+    return steps
+
+
+def _profilers(profile):
+    """Normalizes a step's "profile" option, e.g. "cprofile" or ["cprofile", "tracemalloc"], to a tuple."""
+    if isinstance(profile, str):
+        return (profile,)
+    return tuple(profile or ())
@@ -1,12 +1,181 @@
+import atexit
 import json
+import numbers
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
 from utils.json_enhanced import NumpyEncoder
+from utils.io_utils import atomic_write, estimate_size
 import pandas as pd
 import os
 import tempfile
 
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024  # 512MB
+
+
+class TempObjectStore:
+    """
+    Hands data between stages through handles instead of temporary files.
+
+    A handle is the path the object would be written to, so it can be passed around and stored
+    wherever a temporary file path was used before. Objects are kept in memory and only written
+    to that path when the total size of the objects held exceeds the memory budget (least
+    recently used first) or when a caller needs an actual file. Everything is removed by
+    cleanup(), which runs at the end of a pipeline run and at interpreter exit.
+
+    Objects held in memory are shared with the reader, not copied, so readers must not modify them.
+
+    A forked worker can read the objects it inherits from its parent, but only counts, evicts and
+    spills the ones it stored itself; the parent owns the others and their files.
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, spill_dir=None):
+        self.memory_budget = memory_budget
+        self._spill_dir = spill_dir
+        self._objects = OrderedDict()  # handle -> (data, size, pid of the process that stored it)
+        self._memory_used = 0
+        self._kept = set()
+        self._lock = threading.RLock()
+
+    @property
+    def spill_dir(self):
+        """Directory holding the handles' files, created on first use."""
+        with self._lock:
+            if self._spill_dir is None:
+                self._spill_dir = tempfile.mkdtemp(prefix="devcontrol_")
+            return self._spill_dir
+
+    def is_handle(self, path):
+        return (isinstance(path, str) and self._spill_dir is not None
+                and os.path.dirname(path) == self._spill_dir)
+
+    def put(self, data, suffix=".json"):
+        """Stores data and returns its handle."""
+        if suffix == ".json":
+            # Readers see the same keys as after a round trip through a JSON file
+            data = _json_keys(data)
+        handle = os.path.join(self.spill_dir, f"{uuid.uuid4().hex}{suffix}")
+        size = estimate_size(data)
+        with self._lock:
+            self._objects[handle] = (data, size, os.getpid())
+            self._memory_used += size
+            self._enforce_budget()
+        return handle
+
+    def get(self, handle):
+        """Returns the object of a handle, reading it from disk if it is not held in memory."""
+        with self._lock:
+            entry = self._objects.get(handle)
+            if entry is not None:
+                self._objects.move_to_end(handle)
+                return entry[0]
+        return _read_file(handle)
+
+    def spill(self, handle):
+        """Writes a handle's object to disk if it is only held in memory, and returns the file path."""
+        with self._lock:
+            entry = self._objects.get(handle)
+            if entry is None:
+                return handle
+            data, size, pid = entry
+            if pid != os.getpid():
+                # Inherited from the parent, which keeps it in memory and may spill it as well
+                if not os.path.exists(handle):
+                    _write_file(data, handle)
+                return handle
+            del self._objects[handle]
+            _write_file(data, handle)
+            self._memory_used -= size
+        return handle
+
+    def spill_all(self):
+        """Writes every object this process stored to disk, e.g. before handing handles to another process."""
+        with self._lock:
+            for handle in self._owned():
+                self.spill(handle)
+
+    def delete(self, handle):
+        with self._lock:
+            entry = self._objects.pop(handle, None)
+            if entry is not None and entry[2] == os.getpid():
+                self._memory_used -= entry[1]
+            self._kept.discard(handle)
+        if os.path.exists(handle):
+            os.remove(handle)
+
+    def cleanup(self, keep=()):
+        """
+        Removes all objects and their files.
+
+        Args:
+            keep (iterable): Handles to keep. They are written to disk and left in place, e.g.
+                because they are referenced by the final output of a run.
+        """
+        with self._lock:
+            for handle in keep:
+                if handle in self._objects or os.path.exists(handle):
+                    self.spill(handle)
+                    self._kept.add(handle)
+            self._objects.clear()
+            self._memory_used = 0
+            if self._spill_dir is None or not os.path.isdir(self._spill_dir):
+                return
+            if self._kept:
+                for name in os.listdir(self._spill_dir):
+                    path = os.path.join(self._spill_dir, name)
+                    if path not in self._kept:
+                        os.remove(path)
+            else:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+
+    def stats(self):
+        with self._lock:
+            return {"objects": len(self._objects), "memory_used": self._memory_used,
+                    "memory_budget": self.memory_budget}
+
+    def _owned(self):
+        pid = os.getpid()
+        return [handle for handle, entry in self._objects.items() if entry[2] == pid]
+
+    def _enforce_budget(self):
+        # Least recently used first, always keeping the newest object in memory
+        for handle in self._owned()[:-1]:
+            if self._memory_used <= self.memory_budget:
+                break
+            self.spill(handle)
+
+    def _after_fork_in_child(self):
+        # Inherited objects stay readable but are the parent's to count and spill
+        self._lock = threading.RLock()
+        self._memory_used = 0
+
+
+_store = TempObjectStore()
+atexit.register(_store.cleanup)
+os.register_at_fork(after_in_child=_store._after_fork_in_child)
+
+
+def get_store():
+    """Returns the process-wide store behind write_to_temp_file and read_from_temp_file."""
+    return _store
+
+
+def set_memory_budget(memory_budget):
+    """Sets how many bytes of stage outputs are kept in memory before spilling to disk."""
+    with _store._lock:
+        _store.memory_budget = memory_budget
+        _store._enforce_budget()
+
+
 def write_to_temp_file(data, suffix=".json"):
     """
-    Writes data to a temporary file and returns the file path.
+    Stores data for the next stage and returns its handle.
+
+    The handle is a file path; the data is kept in memory and only written to that path when the
+    store exceeds its memory budget or a caller needs the file (see ensure_temp_file).
 
     Args:
         data (any): Data to write to the file.
@@ -15,16 +184,8 @@ def write_to_temp_file(data, suffix=".json"):
     Returns:
         str: Path to the temporary file.
     """
-    encoder = NumpyEncoder()
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-    if suffix == ".json":
-        with open(temp_file.name, 'w') as f:
-            json_str = encoder.encode(data)
-            f.write(json_str)
-    elif suffix == ".csv":
-        data.to_csv(temp_file.name, index=False)
-    temp_file.close()
-    return temp_file.name
+    return _store.put(data, suffix=suffix)
+
 
 def read_from_temp_file(file_path):
     """
@@ -36,11 +197,99 @@ def read_from_temp_file(file_path):
     Returns:
         any: Data read from the file.
     """
+    return _store.get(file_path)
+
+
+def ensure_temp_file(file_path):
+    """Makes sure the data of a handle exists on disk and returns the file path."""
+    if _store.is_handle(file_path):
+        return _store.spill(file_path)
+    return file_path
+
+
+def is_temp_handle(file_path):
+    """True if file_path is a handle returned by write_to_temp_file."""
+    return _store.is_handle(file_path)
+
+
+def spill_temp_files():
+    """Writes every stage output held in memory to disk."""
+    _store.spill_all()
+
+
+def ensure_spill_dir():
+    """Creates the directory holding the handles' files, e.g. before forking workers that share it."""
+    return _store.spill_dir
+
+
+def resolve_temp_handles(data):
+    """Returns data with every handle in a nested structure of dicts and lists replaced by its data."""
+    if isinstance(data, dict):
+        return {key: resolve_temp_handles(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(resolve_temp_handles(item) for item in data)
+    if _store.is_handle(data):
+        return resolve_temp_handles(_store.get(data))
+    return data
+
+
+def find_temp_handles(data):
+    """Returns the handles referenced anywhere in a nested structure of dicts and lists."""
+    if isinstance(data, dict):
+        return [handle for value in data.values() for handle in find_temp_handles(value)]
+    if isinstance(data, (list, tuple)):
+        return [handle for item in data for handle in find_temp_handles(item)]
+    return [data] if _store.is_handle(data) else []
+
+
+def cleanup_temp_files(keep=()):
+    """Removes all stage outputs except the handles in keep."""
+    _store.cleanup(keep=keep)
+
+
+def delete_temp_file(file_path):
+    if _store.is_handle(file_path):
+        _store.delete(file_path)
+    else:
+        os.remove(file_path)
+
+
+def _write_file(data, file_path):
+    # Atomic, as a reader in another process may open the file as soon as it exists
+    if file_path.endswith(".json"):
+        encoder = NumpyEncoder()
+        with atomic_write(file_path) as f:
+            json_str = encoder.encode(data)
+            f.write(json_str)
+    elif file_path.endswith(".csv"):
+        with atomic_write(file_path) as f:
+            data.to_csv(f, index=False)
+
+
+def _read_file(file_path):
     if file_path.endswith(".json"):
         with open(file_path, 'r') as f:
             return json.load(f)
     elif file_path.endswith(".csv"):
         return pd.read_csv(file_path)
 
-def delete_temp_file(file_path):
-    os.remove(file_path)
\ No newline at end of file
+
+def _json_keys(data):
+    """Converts dict keys to strings as json.dump would, leaving values untouched."""
+    if isinstance(data, dict):
+        return {_json_key(key): _json_keys(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_json_keys(item) for item in data]
+    return data
+
+
+def _json_key(key):
+    if isinstance(key, str):
+        return key
+    if isinstance(key, (bool, type(None))):
+        return json.dumps(key)
+    if isinstance(key, numbers.Integral):
+        return str(int(key))
+    if isinstance(key, numbers.Real):
+        return json.dumps(float(key))
+    return key